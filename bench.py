@@ -0,0 +1,531 @@
+"""Seed a synthetic database, drive server.py over HTTP and WebSocket, report JSON.
+
+    python bench.py seed bench.db --users 2000 --coins 300 --chats 50000
+    python bench.py run --duration 10 --concurrency 16 --ws-clients 100 -o result.json
+    python bench.py run --db bench.db --url http://127.0.0.1:4060 --baseline result.json
+
+`run` seeds a fresh database in a temporary directory and starts uvicorn on it
+unless --db is given (and --url, to target a server that is already running
+on that database). Every scenario runs for a warmup period whose samples are
+discarded, then for --duration seconds. Each worker keeps one connection and
+issues requests back to back. Random choices come from --seed, so two runs at
+the same scale send the same traffic mix.
+
+The exit status is 1 if a scenario completed no requests at all (say every
+WebSocket connect failed); those are listed under "failed" in the result.
+With --baseline, throughput and p99 latency are also compared against an
+earlier result, and any scenario that regressed beyond --tolerance fails too.
+
+Only the standard library is used on the client side, so the harness runs
+anywhere the server does.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import math
+import os
+import platform
+import random
+import socket
+import sqlite3
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from urllib.parse import quote, urlsplit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SEARCH_SHARE = 0.3     # share of /get_coins requests that search instead of paging @All
+PAYMENT_SHARE = 0.1    # share of WebSocket messages that are @payment transfers
+ACK_EVERY = 64         # deliveries between {"ack": seq} frames
+REPLY_TIMEOUT = 10.0
+
+# ---------------------------------------------------------------- seeding
+
+def seed(path, users, coins, holdings, chats, rng_seed):
+    """Create `path` with the server's schema and fill it with synthetic rows."""
+    if os.path.exists(path):
+        os.remove(path)
+    # Importing the server runs init_db against CRYPTOSPHERE_DB, so the schema always matches
+    env = dict(os.environ, CRYPTOSPHERE_DB=path, CRYPTOSPHERE_PRICE_FEED="none")
+    subprocess.run([sys.executable, "-c", "import server"], cwd=HERE, env=env, check=True, stdout=subprocess.DEVNULL)
+
+    rng = random.Random(rng_seed)
+    now = time.time()
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.executemany("INSERT INTO users (id, email, username, password, profilePicture) VALUES (?, ?, ?, ?, ?)",
+                         ((i, f"bench{i}@example.com", f"bench{i}", f"password{i}", f"https://example.com/bench{i}.jpg")
+                          for i in range(1, users + 1)))
+        conn.executemany("INSERT INTO coins (id, coinName, coinSymbol, imageUrl) VALUES (?, ?, ?, ?)",
+                         ((i, f"Benchcoin {i}", f"bc{i}", f"https://example.com/coin{i}.png") for i in range(1, coins + 1)))
+        # Coin 1 is held by everyone so payments and sells always have a balance to draw on
+        rows = []
+        for user_id in range(1, users + 1):
+            held = {1} | set(rng.sample(range(1, coins + 1), min(coins, holdings)))
+            rows += [(user_id, coin_id, 1000000.0 if coin_id == 1 else round(rng.uniform(0.01, 100), 4)) for coin_id in held]
+        conn.executemany("INSERT INTO user_coins (user_id, coin_id, quantity) VALUES (?, ?, ?)", rows)
+        conn.executemany("INSERT INTO ledger (user_id, coin_id, delta, kind, timestamp) VALUES (?, ?, ?, 'opening', ?)",
+                         ((*row, now) for row in rows))
+        # Conversations concentrate on the first users, the ones the WebSocket clients log in as
+        active = min(users, 200)
+        start = int(now) - chats
+        conn.executemany("INSERT INTO chats (id, from_user, to_user, message, timestamp) VALUES (?, ?, ?, ?, ?)",
+                         ((i, *[f"bench{u}" for u in rng.sample(range(1, active + 1), 2)], f"seeded message {i}", start + i)
+                          for i in range(1, chats + 1)))
+    conn.close()
+    return {"users": users, "coins": coins, "holdings_per_user": holdings, "chats": chats}
+
+# ---------------------------------------------------------------- clients
+
+class HttpConnection:
+    """Keep-alive HTTP/1.1 GET client over one socket."""
+
+    def __init__(self, host, port):
+        self.host, self.port = host, port
+        self.reader = self.writer = None
+
+    async def get(self, path):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.writer.write(f"GET {path} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\n\r\n".encode())
+        try:
+            status = int((await self.reader.readuntil(b"\r\n")).split()[1])
+            headers = {}
+            while (line := await self.reader.readuntil(b"\r\n")) != b"\r\n":
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            if headers.get("transfer-encoding") == "chunked":
+                while size := int((await self.reader.readuntil(b"\r\n")).split(b";")[0], 16):
+                    await self.reader.readexactly(size + 2)
+                await self.reader.readuntil(b"\r\n")
+            else:
+                await self.reader.readexactly(int(headers.get("content-length", 0)))
+            if headers.get("connection") == "close":
+                self.close()
+            return status
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self.close()
+            raise
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+class WebSocketConnection:
+    """Minimal RFC 6455 client: text frames out (masked), text/ping/close in."""
+
+    def __init__(self, reader, writer):
+        self.reader, self.writer = reader, writer
+
+    @classmethod
+    async def connect(cls, host, port, path):
+        reader, writer = await asyncio.open_connection(host, port)
+        key = base64.b64encode(os.urandom(16)).decode()
+        writer.write((f"GET {path} HTTP/1.1\r\nHost: {host}:{port}\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                      f"Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n").encode())
+        response = await reader.readuntil(b"\r\n\r\n")
+        if b" 101 " not in response.split(b"\r\n", 1)[0]:
+            writer.close()
+            raise ConnectionError(response.split(b"\r\n", 1)[0].decode("latin-1"))
+        return cls(reader, writer)
+
+    def _frame(self, opcode, payload):
+        mask = os.urandom(4)
+        length = len(payload)
+        if length < 126:
+            header = struct.pack("!BB", 0x80 | opcode, 0x80 | length)
+        elif length < 65536:
+            header = struct.pack("!BBH", 0x80 | opcode, 0x80 | 126, length)
+        else:
+            header = struct.pack("!BBQ", 0x80 | opcode, 0x80 | 127, length)
+        key = int.from_bytes((mask * (length // 4 + 1))[:length], "big")
+        masked = (int.from_bytes(payload, "big") ^ key).to_bytes(length, "big")
+        self.writer.write(header + mask + masked)
+
+    def send_json(self, data):
+        self._frame(0x1, json.dumps(data).encode())
+
+    async def receive_json(self):
+        message = b""
+        while True:
+            first, second = await self.reader.readexactly(2)
+            length = second & 0x7F
+            if length == 126:
+                length = struct.unpack("!H", await self.reader.readexactly(2))[0]
+            elif length == 127:
+                length = struct.unpack("!Q", await self.reader.readexactly(8))[0]
+            mask = await self.reader.readexactly(4) if second & 0x80 else None
+            payload = await self.reader.readexactly(length)
+            if mask:
+                payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+            opcode = first & 0x0F
+            if opcode == 0x8:
+                raise ConnectionError("closed by server")
+            if opcode == 0x9:
+                self._frame(0xA, payload)
+                continue
+            if opcode in (0x0, 0x1, 0x2):
+                message += payload
+                if first & 0x80:
+                    return json.loads(message)
+
+    def close(self):
+        try:
+            self._frame(0x8, struct.pack("!H", 1000))
+        finally:
+            self.writer.close()
+
+# ---------------------------------------------------------------- measurement
+
+def percentiles(samples):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    pick = lambda q: ordered[min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))]
+    return {"p50": round(pick(0.50) * 1000, 3), "p90": round(pick(0.90) * 1000, 3), "p99": round(pick(0.99) * 1000, 3),
+            "max": round(ordered[-1] * 1000, 3), "mean": round(sum(ordered) / len(ordered) * 1000, 3)}
+
+class Recorder:
+    def __init__(self):
+        self.samples, self.errors, self.recording = [], 0, False
+
+    def add(self, seconds):
+        if self.recording:
+            self.samples.append(seconds)
+
+    def error(self):
+        if self.recording:
+            self.errors += 1
+
+    def report(self, elapsed=None):
+        return {"requests": len(self.samples), "errors": self.errors,
+                "throughput_rps": round(len(self.samples) / elapsed, 1) if elapsed else None,
+                "latency_ms": percentiles(self.samples)}
+
+async def timed(recorders, warmup, duration, workers):
+    """Run `workers` coroutines through warmup, then record for `duration`."""
+    stop = asyncio.Event()
+    tasks = [asyncio.create_task(worker(stop)) for worker in workers]
+    await asyncio.sleep(warmup)
+    for recorder in recorders:
+        recorder.recording = True
+    started = time.perf_counter()
+    await asyncio.sleep(duration)
+    for recorder in recorders:
+        recorder.recording = False
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return elapsed
+
+# ---------------------------------------------------------------- scenarios
+
+def http_scenarios(data):
+    users, coins, pairs = data["users"], data["coins"], data["pairs"]
+    pages = max(1, math.ceil(len(coins) / 25))
+
+    def get_coins(rng):
+        if rng.random() < SEARCH_SHARE:
+            yield f"/get_coins/1/{quote(rng.choice(['bc', 'Benchcoin ']) + str(rng.choice(coins)))}"
+        else:
+            yield f"/get_coins/{rng.randint(1, pages)}/@All"
+
+    def userholdings(rng):
+        yield f"/userholdings/{quote(rng.choice(users))}"
+
+    def trade(rng):
+        query = f"username={quote(rng.choice(users))}&coin_id={rng.choice(coins)}&quantity=0.5"
+        yield f"/buy_coin?{query}"
+        yield f"/sell_coin?{query}"
+
+    def chat_history(rng):
+        # The full reload the app does on every reconnect
+        yield f"/get_chat_history/{quote(rng.choice(pairs)[0])}"
+
+    def conversation(rng):
+        from_user, to_user = rng.choice(pairs)
+        yield f"/get_chat_history/{quote(from_user)}/{quote(to_user)}"
+
+    return {"get_coins": get_coins, "userholdings": userholdings, "trade": trade, "chat_history": chat_history,
+            "conversation": conversation}
+
+async def run_http(name, paths, host, port, args):
+    recorder = Recorder()
+
+    def worker(index):
+        rng = random.Random(f"{args.seed}:{name}:{index}")
+
+        async def loop(stop):
+            conn = HttpConnection(host, port)
+            try:
+                while not stop.is_set():
+                    for path in paths(rng):
+                        started = time.perf_counter()
+                        try:
+                            status = await conn.get(path)
+                        except (OSError, asyncio.IncompleteReadError):
+                            recorder.error()
+                            continue
+                        recorder.add(time.perf_counter() - started)
+                        if status >= 400:
+                            recorder.error()
+            finally:
+                conn.close()
+        return loop
+
+    elapsed = await timed([recorder], args.warmup, args.duration, [worker(i) for i in range(args.concurrency)])
+    return recorder.report(elapsed)
+
+async def run_websocket(host, port, data, args):
+    """Chat and @payment traffic between --ws-clients connected users."""
+    names = data["users"][:args.ws_clients]
+    if len(names) < 2:
+        return None
+    connect, chat, payment, delivery = Recorder(), Recorder(), Recorder(), Recorder()
+    connect.recording = True
+    gate = asyncio.Semaphore(50)
+
+    async def open_socket(name):
+        async with gate:
+            started = time.perf_counter()
+            try:
+                ws = await WebSocketConnection.connect(host, port, f"/ws/{quote(name)}")
+            except (OSError, asyncio.IncompleteReadError):
+                connect.error()
+                return None
+            connect.add(time.perf_counter() - started)
+            return ws
+
+    sockets = await asyncio.gather(*(open_socket(name) for name in names))
+    clients = [(name, ws) for name, ws in zip(names, sockets) if ws]
+    connect.recording = False
+    if len(clients) < 2:
+        for _, ws in clients:
+            ws.close()
+        return {"clients": len(clients), "connect": connect.report()}
+
+    def worker(index):
+        name, ws = clients[index]
+        rng = random.Random(f"{args.seed}:ws:{index}")
+
+        async def loop(stop):
+            replies = asyncio.Queue()
+            acked = last_seq = 0
+
+            async def read():
+                nonlocal acked, last_seq
+                while True:
+                    data = await ws.receive_json()
+                    if data.get("from") == name or "error" in data:
+                        replies.put_nowait(data)
+                        continue
+                    if str(data.get("message", "")).startswith("bench "):
+                        delivery.add(time.perf_counter() - float(data["message"].split()[1]))
+                    last_seq = max(last_seq, data.get("seq", 0))
+                    if last_seq - acked >= ACK_EVERY:
+                        ws.send_json({"ack": last_seq})
+                        acked = last_seq
+
+            reader = asyncio.create_task(read())
+            try:
+                while not stop.is_set():
+                    recipient = rng.choice(clients)[0]
+                    if recipient == name:
+                        continue
+                    started = time.perf_counter()
+                    if rng.random() < PAYMENT_SHARE:
+                        recorder = payment
+                        ws.send_json({"to": recipient, "message": f"@payment,1,0.001,{recipient}_1",
+                                      "idempotency_key": str(uuid.UUID(int=rng.getrandbits(128)))})
+                    else:
+                        recorder = chat
+                        ws.send_json({"to": recipient, "message": f"bench {started}"})
+                    try:
+                        reply = await asyncio.wait_for(replies.get(), REPLY_TIMEOUT)
+                    except asyncio.TimeoutError:
+                        recorder.error()
+                        continue
+                    recorder.add(time.perf_counter() - started)
+                    if "error" in reply:
+                        recorder.error()
+            finally:
+                reader.cancel()
+        return loop
+
+    elapsed = await timed([chat, payment, delivery], args.warmup, args.duration, [worker(i) for i in range(len(clients))])
+    for _, ws in clients:
+        ws.close()
+    return {"clients": len(clients), "connect": connect.report(),
+            "chat": chat.report(elapsed), "payment": payment.report(elapsed), "delivery": delivery.report(elapsed)}
+
+# ---------------------------------------------------------------- orchestration
+
+def load_targets(path):
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    users = [row[0] for row in conn.execute("SELECT username FROM users ORDER BY id")]
+    coins = [row[0] for row in conn.execute("SELECT id FROM coins ORDER BY id")]
+    pairs = conn.execute("SELECT from_user, to_user FROM chats GROUP BY from_user, to_user LIMIT 1000").fetchall()
+    conn.close()
+    return {"users": users, "coins": coins, "pairs": pairs or [(users[0], users[-1])]}
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_server(db_path, port, scratch):
+    # Candles go to scratch space too, so a run neither writes to the checkout nor contends with a dev server there
+    env = dict(os.environ, CRYPTOSPHERE_DB=db_path, CRYPTOSPHERE_PRICE_FEED="none", CRYPTOSPHERE_BACKPLANE="local",
+               CRYPTOSPHERE_CANDLES=os.path.join(scratch, "candles"))
+    process = subprocess.Popen([sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1", "--port", str(port),
+                                "--log-level", "warning", "--no-access-log"],
+                               cwd=HERE, env=env, stdout=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"server exited with {process.returncode}")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("server did not start within 30s")
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(),
+            "commit": commit or None}
+
+def failures(scenarios):
+    """Scenarios that measured nothing, so their numbers must not pass for a result."""
+    failed = []
+    for name, report in scenarios.items():
+        if name == "websocket":
+            if report is None:
+                failed.append("websocket: needs at least two users")
+            elif report["clients"] < 2:
+                failed.append(f"websocket: {report['clients']} clients connected, {report['connect']['errors']} connects failed")
+            elif not report["chat"]["requests"]:
+                failed.append(f"websocket: no chat message completed ({report['chat']['errors']} errors)")
+        elif not report["requests"]:
+            failed.append(f"{name}: no request completed ({report['errors']} errors)")
+    return failed
+
+def compare(result, baseline, tolerance):
+    """Scenarios whose throughput fell or p99 rose by more than `tolerance`."""
+    regressions = []
+    flatten = lambda r: {**{k: v for k, v in r["scenarios"].items() if k != "websocket"},
+                         **{f"ws_{k}": v for k, v in (r["scenarios"].get("websocket") or {}).items() if isinstance(v, dict)}}
+    before, after = flatten(baseline), flatten(result)
+    for name, now in after.items():
+        then = before.get(name)
+        if not then or not then.get("latency_ms") or not now.get("latency_ms"):
+            continue
+        if then.get("throughput_rps") and now["throughput_rps"] < then["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {then['throughput_rps']} -> {now['throughput_rps']} rps")
+        if now["latency_ms"]["p99"] > then["latency_ms"]["p99"] * (1 + tolerance):
+            regressions.append(f"{name}: p99 {then['latency_ms']['p99']} -> {now['latency_ms']['p99']} ms")
+    return regressions
+
+async def benchmark(host, port, data, args):
+    scenarios = {}
+    for name, paths in http_scenarios(data).items():
+        if args.only and name not in args.only:
+            continue
+        scenarios[name] = await run_http(name, paths, host, port, args)
+        print(f"⏱️ {name}: {scenarios[name]['throughput_rps']} rps", file=sys.stderr)
+    if args.ws_clients and (not args.only or "websocket" in args.only):
+        scenarios["websocket"] = await run_websocket(host, port, data, args)
+        chat = (scenarios["websocket"] or {}).get("chat") or {}
+        print(f"⏱️ websocket: {chat.get('throughput_rps')} msg/s", file=sys.stderr)
+    return scenarios
+
+def run(args):
+    workdir = tempfile.TemporaryDirectory()
+    scale = None
+    if args.db is None:
+        args.db = os.path.join(workdir.name, "bench.db")
+        scale = seed(args.db, args.users, args.coins, args.holdings, args.chats, args.seed)
+    server = None
+    try:
+        if args.url:
+            target = urlsplit(args.url)
+            host, port = target.hostname, target.port or 80
+        else:
+            host, port = "127.0.0.1", free_port()
+            server = start_server(args.db, port, workdir.name)
+        data = load_targets(args.db)
+        result = {
+            "config": {"duration": args.duration, "warmup": args.warmup, "concurrency": args.concurrency,
+                       "ws_clients": args.ws_clients, "seed": args.seed,
+                       "scale": scale or {"users": len(data["users"]), "coins": len(data["coins"])}},
+            "environment": environment(),
+            "scenarios": asyncio.run(benchmark(host, port, data, args)),
+        }
+        result["failed"] = failures(result["scenarios"])
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+        workdir.cleanup()
+
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    for failure in result["failed"]:
+        print(f"❌ {failure}", file=sys.stderr)
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"📉 {regression}", file=sys.stderr)
+    return 1 if result["failed"] or regressions else 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    scale = argparse.ArgumentParser(add_help=False)
+    scale.add_argument("--users", type=int, default=1000)
+    scale.add_argument("--coins", type=int, default=200)
+    scale.add_argument("--holdings", type=int, default=5, help="coins held per user")
+    scale.add_argument("--chats", type=int, default=20000)
+    scale.add_argument("--seed", type=int, default=42)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    seeding = sub.add_parser("seed", parents=[scale])
+    seeding.add_argument("db")
+
+    running = sub.add_parser("run", parents=[scale])
+    running.add_argument("--db", help="existing database (default: seed a temporary one)")
+    running.add_argument("--url", help="server already running on --db (default: start one)")
+    running.add_argument("--duration", type=float, default=10.0)
+    running.add_argument("--warmup", type=float, default=2.0)
+    running.add_argument("--concurrency", type=int, default=16, help="HTTP connections per scenario")
+    running.add_argument("--ws-clients", type=int, default=50)
+    running.add_argument("--only", nargs="*", help="scenarios to run: get_coins userholdings trade chat_history conversation websocket")
+    running.add_argument("-o", "--output")
+    running.add_argument("--baseline", help="earlier result to compare against")
+    running.add_argument("--tolerance", type=float, default=0.15)
+    args = parser.parse_args(argv)
+
+    if args.command == "seed":
+        print(json.dumps(seed(args.db, args.users, args.coins, args.holdings, args.chats, args.seed)))
+        return 0
+    if args.url and not args.db:
+        parser.error("--url needs --db so the harness knows which users and coins exist")
+    return run(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,116 @@
+"""Stream tables out of and back into the database as (compressed) NDJSON.
+
+    python bulk.py export users -o users.ndjson.gz     # users, coins, holdings or chats
+    python bulk.py export chats --fields id,from_user,to_user,message,timestamp -o - | ...
+    python bulk.py import coins coins.ndjson.zst
+
+Compression follows the file extension: .gz is gzip, .zst is zstd (needs the
+zstandard package), anything else is plain NDJSON; "-" is stdin/stdout.
+Exports include every column, passwords too, so they can be restored as-is.
+Imports commit every IMPORT_BATCH_SIZE records in one write transaction, so a
+running server picks up coin changes through the catalog version triggers.
+Set CRYPTOSPHERE_DB to point at a database other than chat.db.
+"""
+import argparse
+import json
+import sys
+
+from server import EXPORT_CHUNK_SIZE, EXPORT_TABLES, IMPORT_BATCH_SIZE, compressor, db, decompressor, dumps, export_page, import_rows
+
+READ_SIZE = 1 << 16
+
+def encoding_for(path):
+    if path.endswith(".zst"):
+        return "zstd"
+    if path.endswith(".gz"):
+        return "gzip"
+    return "identity"
+
+def export(table, fields, path):
+    conn = db.connect()
+    out = sys.stdout.buffer if path == "-" else open(path, "wb")
+    encoder = compressor(encoding_for(path))
+    after, count = 0, 0
+    try:
+        while True:
+            records, after = export_page(conn, table, after, EXPORT_CHUNK_SIZE, fields)
+            chunk = b"".join(dumps(record) + b"\n" for record in records)
+            out.write(encoder.compress(chunk) if encoder else chunk)
+            count += len(records)
+            if len(records) < EXPORT_CHUNK_SIZE:
+                break
+        if encoder:
+            out.write(encoder.flush())
+    finally:
+        if out is not sys.stdout.buffer:
+            out.close()
+        conn.close()
+    print(f"📤 Exported {count} {table}", file=sys.stderr)
+    return 0
+
+def read_records(path):
+    """Records from an NDJSON file, decompressed and parsed a block at a time."""
+    source = sys.stdin.buffer if path == "-" else open(path, "rb")
+    decoder = decompressor(encoding_for(path))
+    pending = b""
+    try:
+        while block := source.read(READ_SIZE):
+            pending += decoder.decompress(block) if decoder else block
+            *lines, pending = pending.split(b"\n")
+            yield from (json.loads(line) for line in lines if line.strip())
+        if pending.strip():
+            yield json.loads(pending)
+    finally:
+        if source is not sys.stdin.buffer:
+            source.close()
+
+def commit_batch(conn, table, records):
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        applied = import_rows(conn, table, records)
+        conn.commit()
+        return applied
+    except BaseException:
+        conn.rollback()
+        raise
+
+def load(table, path):
+    conn = db.connect()
+    batch, read, applied = [], 0, 0
+    try:
+        for record in read_records(path):
+            batch.append(record)
+            if len(batch) == IMPORT_BATCH_SIZE:
+                applied += commit_batch(conn, table, batch)
+                read, batch = read + len(batch), []
+        if batch:
+            applied += commit_batch(conn, table, batch)
+            read += len(batch)
+    finally:
+        conn.close()
+    print(f"📥 Imported {applied} of {read} {table}", file=sys.stderr)
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    out = sub.add_parser("export")
+    out.add_argument("table", choices=list(EXPORT_TABLES))
+    out.add_argument("-o", "--output", default="-")
+    out.add_argument("--fields", help="comma-separated columns (default: all)")
+    into = sub.add_parser("import")
+    into.add_argument("table", choices=list(EXPORT_TABLES))
+    into.add_argument("input", nargs="?", default="-")
+    args = parser.parse_args(argv)
+
+    if args.command == "export":
+        columns = EXPORT_TABLES[args.table][1]
+        fields = tuple(field.strip() for field in args.fields.split(",")) if args.fields else columns
+        unknown = [field for field in fields if field not in columns]
+        if unknown:
+            parser.error(f"unknown fields for {args.table}: {', '.join(unknown)}")
+        return export(args.table, fields, args.output)
+    return load(args.table, args.input)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,11 +1,1191 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Query, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 import sqlite3
 from pydantic import BaseModel
-from typing import List, Dict
+from typing import List, Dict, Literal
+import asyncio
+import bisect
+import collections
+import hashlib
+import json
+import logging
+import logging.handlers
+import mmap
+import queue
+import struct
+import sys
+import threading
+import uuid
+import weakref
+import urllib.request
+import zlib
+from array import array
+
+try:
+    import numpy as np
+except ImportError:  # portfolio valuation falls back to pure Python
+    np = None
+try:
+    import orjson
+except ImportError:  # responses fall back to the stdlib encoder
+    orjson = None
+try:
+    import zstandard
+except ImportError:  # exports are gzip-only without it
+    zstandard = None
+try:
+    import fcntl
+except ImportError:  # no advisory file locks (Windows): every process writes candles
+    fcntl = None
 import time
 import math
+import os
+
+DB_PATH = os.environ.get("CRYPTOSPHERE_DB", "chat.db")
+DB_WORKERS = int(os.environ.get("CRYPTOSPHERE_DB_WORKERS", "8"))
+CHAT_FLUSH_SIZE = 256        # messages per group commit
+CHAT_FLUSH_INTERVAL = float(os.environ.get("CRYPTOSPHERE_CHAT_FLUSH_INTERVAL", "0"))  # seconds a batch waits for more messages; 0 = commit once the writer is idle
+CHAT_QUEUE_SIZE = 10000
+CHAT_DURABLE = os.environ.get("CRYPTOSPHERE_CHAT_DURABLE", "0") == "1"  # fsync chat commits and echo to the sender only after one
+PENDING_PAGE_SIZE = 500      # pending deliveries streamed per query on resume
+CATALOG_POLL_INTERVAL = 2.0  # seconds between checks for coin changes made by other processes
+CATALOG_MAX_AGE = 60         # Cache-Control max-age for coin lookups
+SEARCH_CACHE_SIZE = 1024     # ranked search results kept per catalog build
+PRICE_FEED = os.environ.get("CRYPTOSPHERE_PRICE_FEED", "bybit")  # "bybit", "replay:<file.ndjson>" or "none"
+PRICE_POLL_INTERVAL = 1.0    # seconds between upstream ticker polls
+BYBIT_TICKERS_URL = "https://api.bybit.com/v5/market/tickers?category=spot"
+CANDLE_DIR = os.environ.get("CRYPTOSPHERE_CANDLES", "candles")  # one file per interval and symbol
+CANDLE_INTERVALS = {"1m": 60_000, "5m": 300_000, "1h": 3_600_000, "1d": 86_400_000}  # rolled up as ticks arrive
+CANDLE_FLUSH_INTERVAL = 5.0  # seconds between rewrites of still-open candles, which other workers read
+HISTORY_POINTS = 800         # default and maximum candles per /history response, as Bybit's kline limit
+PORTFOLIO_PRICE_TOLERANCE = 0.005  # revalue a cached portfolio once a price moves more than 0.5%
+PORTFOLIO_HOLDINGS_TTL = 30.0      # seconds cached holdings are trusted without a local write
+BACKPLANE_URL = os.environ.get("CRYPTOSPHERE_BACKPLANE", "local")  # "local" or "redis://host:port"
+PRESENCE_TTL = 30            # seconds a presence entry outlives its worker's last refresh
+PRESENCE_REFRESH = 10.0      # seconds between presence refreshes for connected users
+SEND_QUEUE_SIZE = 256        # outbound frames buffered per chat socket
+SEND_OVERFLOW = os.environ.get("CRYPTOSPHERE_SEND_OVERFLOW", "drop_oldest")  # full queue: "drop_oldest" or "disconnect"
+SEND_TIMEOUT = 10.0          # seconds one frame may stall before the socket is treated as dead
+HEARTBEAT_INTERVAL = 20.0    # seconds between protocol pings, and between idle checks
+HEARTBEAT_TIMEOUT = 20.0     # seconds to wait for a pong before the server drops the socket
+CHAT_IDLE_TIMEOUT = float(os.environ.get("CRYPTOSPHERE_CHAT_IDLE_TIMEOUT", "0"))  # reap sockets silent this long; 0 = never
+LOG_LEVEL = os.environ.get("CRYPTOSPHERE_LOG_LEVEL", "INFO").upper()  # per-request and per-message lines are DEBUG
+PROFILER_ENABLED = os.environ.get("CRYPTOSPHERE_PROFILER", "0") == "1"  # serve /debug/profile
+PROFILE_MAX_SECONDS = 60
+
+# Handlers only enqueue records; the listener thread formats and writes them
+log = logging.getLogger("cryptosphere")
+log.setLevel(LOG_LEVEL)
+log.propagate = False
+_log_queue = queue.SimpleQueue()
+log.addHandler(logging.handlers.QueueHandler(_log_queue))
+_log_output = logging.StreamHandler()
+_log_output.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+log_listener = logging.handlers.QueueListener(_log_queue, _log_output)
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+metrics: List["Metric"] = []
+
+class Metric:
+    """A Prometheus metric family whose samples are keyed by label values.
+
+    Updates come from the event loop and from database worker threads alike,
+    so each family guards its samples with a lock.
+    """
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._samples = {}
+        self._lock = threading.Lock()
+        metrics.append(self)
+
+    def _label_text(self, values, extra: str = "") -> str:
+        pairs = [f'{label}="{escape_label(value)}"' for label, value in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self):
+        with self._lock:
+            return [(key, value) for key, value in self._samples.items()]
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{self.name}{self._label_text(key)} {value}" for key, value in self.samples()]
+        return lines
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._samples[labels] = self._samples.get(labels, 0) + amount
+
+class Gauge(Metric):
+    """Set directly, or computed at scrape time when given a `function`."""
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), function=None):
+        super().__init__(name, documentation, labels)
+        self.function = function
+
+    def set(self, value: float, *labels):
+        with self._lock:
+            self._samples[labels] = value
+
+    def samples(self):
+        if self.function is not None:
+            return [((), self.function())]
+        return super().samples()
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            sample = self._samples.get(labels)
+            if sample is None:
+                # Per-bucket counts (plus +Inf), sum, count
+                sample = self._samples[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            sample[0][index] += 1
+            sample[1] += value
+            sample[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            samples = [(key, list(counts), total, count) for key, (counts, total, count) in self._samples.items()]
+        for key, counts, total, count in samples:
+            cumulative = 0
+            for bound, bucket in zip((*self.buckets, "+Inf"), counts):
+                cumulative += bucket
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{self._label_text(key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{self._label_text(key)} {total}")
+            lines.append(f"{self.name}_count{self._label_text(key)} {count}")
+        return lines
+
+def render_metrics() -> str:
+    return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+http_duration = Histogram("cryptosphere_http_request_duration_seconds", "HTTP request latency by route template.",
+                          ("method", "route", "status"))
+db_duration = Histogram("cryptosphere_db_query_duration_seconds",
+                        "Time a query function held its pooled connection, transaction included.", ("query", "mode"))
+db_wait = Histogram("cryptosphere_db_queue_wait_seconds", "Time a query waited for a free database worker.", ("mode",))
+db_rows = Counter("cryptosphere_db_rows_written_total", "Rows inserted, updated or deleted by a query function.", ("query",))
+db_errors = Counter("cryptosphere_db_errors_total", "Query functions that failed with an SQLite error.", ("query",))
+ws_connections = Gauge("cryptosphere_ws_connections", "Chat WebSockets open on this node.",
+                       function=lambda: len(active_connections))
+price_subscribers = Gauge("cryptosphere_price_subscribers", "Price stream WebSockets open on this node.",
+                          function=lambda: price_hub.subscriber_count())
+chat_queue_depth = Gauge("cryptosphere_chat_write_queue_depth", "Chat messages waiting for the next group commit.",
+                         function=lambda: chat_writer.depth())
+chat_messages = Counter("cryptosphere_chat_messages_total", "Chat messages accepted for storage.")
+chat_fanout = Histogram("cryptosphere_chat_fanout_seconds", "From receiving a chat message to queueing it for the recipient.")
+ws_queue_depth = Gauge("cryptosphere_ws_send_queue_depth", "Frames waiting in chat send queues on this node.",
+                       function=lambda: sum(len(client.frames) for client in list(active_connections.values())))
+ws_dropped_frames = Counter("cryptosphere_ws_dropped_frames_total", "Frames dropped because a chat send queue was full.")
+ws_reaped = Counter("cryptosphere_ws_reaped_total", "Chat sockets closed by the server, by reason.", ("reason",))
+ws_send_failures = Counter("cryptosphere_ws_send_failures_total", "WebSocket sends that raised, by what was being sent.",
+                           ("kind",))
+payment_outcomes = Counter("cryptosphere_payments_total", "@payment messages by outcome.", ("outcome",))
+candles_written = Counter("cryptosphere_candles_written_total", "OHLC candle records written, closed or refreshed.",
+                          ("interval",))
+
+_query_names: Dict[object, str] = {}
+
+def query_name(fn) -> str:
+    """Stable metric label for a query function, e.g. "get_wallet_details.query"."""
+    code = getattr(fn, "__code__", fn)
+    name = _query_names.get(code)
+    if name is None:
+        name = _query_names[code] = getattr(fn, "__qualname__", repr(fn)).replace(".<locals>", "")
+    return name
+
+def sample_stacks(seconds: float, interval: float) -> Dict[str, int]:
+    """Sample every other thread's stack for `seconds`; returns folded stacks with hit counts."""
+    counts: Dict[str, int] = {}
+    me = threading.get_ident()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            folded = ";".join([names.get(ident, str(ident)), *reversed(stack)])
+            counts[folded] = counts.get(folded, 0) + 1
+        time.sleep(interval)
+    return counts
+
+
+class Database:
+    """Pool of reusable SQLite connections driven from bounded thread pools.
+
+    Each worker thread owns one connection, configured once on first use, so
+    handlers never pay for connect/close and blocking queries never run on the
+    event loop. Every call executes inside a single transaction, reads too, so
+    a query function that runs several SELECTs sees one consistent snapshot.
+    Reads run on a pool of `workers` threads. Writes run one at a time on a
+    thread of their own, so they queue here instead of on the SQLite lock, and
+    writers held up by a long transaction (another process's included) never
+    occupy the threads reads need; under WAL those reads carry on meanwhile.
+    """
+
+    def __init__(self, path: str, workers: int):
+        self.path = path
+        self.workers = workers
+        self._executor: ThreadPoolExecutor = None
+        self._writer: ThreadPoolExecutor = None
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+
+    def connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, cached_statements=256)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA mmap_size=268435456")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA busy_timeout=30000")
+        return conn
+
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self.connect()
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def _call(self, fn, args, immediate=False, queued=None, durable=False):
+        started = time.perf_counter()
+        name, mode = query_name(fn), "write" if immediate else "read"
+        if queued is not None:
+            db_wait.observe(started - queued, mode)
+        conn = self.connection()
+        changes = conn.total_changes
+        if durable:
+            # Under WAL, NORMAL leaves a commit unsynced until the next checkpoint
+            conn.execute("PRAGMA synchronous=FULL")
+        try:
+            with conn:  # commit on success, rollback on error
+                # sqlite3 opens no transaction of its own for SELECTs
+                conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+                return fn(conn, *args)
+        except sqlite3.Error:
+            db_errors.inc(name)
+            raise
+        finally:
+            if durable:
+                conn.execute("PRAGMA synchronous=NORMAL")
+            db_duration.observe(time.perf_counter() - started, name, mode)
+            if conn.total_changes != changes:
+                db_rows.inc(name, amount=conn.total_changes - changes)
+
+    def _submit(self, fn, args, immediate, durable=False):
+        if immediate:
+            if self._writer is None:
+                self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+            executor = self._writer
+        else:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="db")
+            executor = self._executor
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(executor, self._call, fn, args, immediate, time.perf_counter(), durable)
+
+    async def run(self, fn, *args):
+        """Run `fn(conn, *args)` on a pooled connection off the event loop."""
+        return await self._submit(fn, args, False)
+
+    async def write(self, fn, *args, durable: bool = False):
+        """Like `run`, but on the writer thread, taking the write lock up front with BEGIN IMMEDIATE.
+
+        With `durable`, the commit is fsynced before this returns.
+        """
+        return await self._submit(fn, args, True, durable)
+
+    def close(self):
+        for executor in (self._executor, self._writer):
+            if executor is not None:
+                executor.shutdown(wait=True)
+        self._executor = self._writer = None
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+db = Database(DB_PATH, DB_WORKERS)
+
+class ChatWriter:
+    """Write-behind queue that persists chat messages in group commits.
+
+    A batch is written with one executemany and one commit once `max_batch`
+    messages are waiting or `max_delay` has passed since the first one. With
+    no delay a lone message is committed straight away, and messages that
+    queue up while a commit is in flight go into the next one together. With
+    `durable`, each commit is fsynced before its messages resolve. Each
+    message also gets the next delivery sequence number of its recipient and a
+    pending-delivery row, removed once the recipient acks it.
+    """
+
+    def __init__(self, db: Database, max_batch: int, max_delay: float, max_queue: int, durable: bool = False):
+        self.db = db
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_queue = max_queue
+        self.durable = durable
+        self._queue: asyncio.Queue = None
+        self._task: asyncio.Task = None
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        await self._queue.put(None)
+        await self._task
+
+    async def save(self, from_user: str, to_user: str, message: str, timestamp: int) -> asyncio.Future:
+        """Queue a message; the returned future resolves to the recipient's seq once committed."""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(((from_user, to_user, message, timestamp), future))
+        return future
+
+    @staticmethod
+    def _insert(conn, rows):
+        # Runs under BEGIN IMMEDIATE, so ids and sequence numbers cannot race another writer
+        first_id = conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM chats").fetchone()[0]
+        recipients = list({row[1] for row in rows if row[1] is not None})
+        last_seq = dict(conn.execute("SELECT username, last_seq FROM delivery_seq WHERE username IN (SELECT value FROM json_each(?))",
+                                     (json.dumps(recipients),)).fetchall())
+        chats, pending, seqs = [], [], []
+        for chat_id, (from_user, to_user, message, timestamp) in enumerate(rows, first_id):
+            chats.append((chat_id, from_user, to_user, message, timestamp))
+            if to_user is None:
+                seqs.append(None)
+                continue
+            seq = last_seq[to_user] = last_seq.get(to_user, 0) + 1
+            pending.append((to_user, seq, chat_id))
+            seqs.append(seq)
+        conn.executemany("INSERT INTO chats (id, from_user, to_user, message, timestamp) VALUES (?, ?, ?, ?, ?)", chats)
+        conn.executemany("INSERT INTO pending_deliveries (username, seq, chat_id) VALUES (?, ?, ?)", pending)
+        conn.executemany('''INSERT INTO delivery_seq (username, last_seq) VALUES (?, ?)
+                              ON CONFLICT (username) DO UPDATE SET last_seq = excluded.last_seq''',
+                         [(username, last_seq[username]) for username in recipients])
+        return seqs
+
+    async def _flush_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self._queue.get()
+            deadline = loop.time() + self.max_delay
+            batch = []
+            while item is not None:
+                batch.append(item)
+                if len(batch) == self.max_batch:
+                    break
+                if not self._queue.empty():
+                    item = self._queue.get_nowait()
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            if batch:
+                await self._flush(batch)
+            if item is None:
+                return
+
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def _flush(self, batch):
+        try:
+            seqs = await self.db.write(self._insert, [row for row, _ in batch], durable=self.durable)
+        except Exception as e:
+            log.error("⚠️ Failed to save %d messages: %s", len(batch), e)
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), seq in zip(batch, seqs):
+            if not future.done():
+                future.set_result(seq)
+
+chat_writer = ChatWriter(db, CHAT_FLUSH_SIZE, CHAT_FLUSH_INTERVAL, CHAT_QUEUE_SIZE, CHAT_DURABLE)
+
+def normalize_symbol(symbol: str) -> str:
+    return symbol.lower().replace("usdt", "")
+
+class CoinSearch:
+    """Substring search over the coins, ranked the way /get_coins pages them.
+
+    Every 1-3 character gram of each lower-cased symbol and name maps to the
+    positions, in coinName order, of the coins containing it. A term of up to
+    three characters is a single posting list; a longer one is checked against
+    the shortest posting list of its trigrams. Ranked results are cached per
+    term, single characters up front, so paging a broad term is a list slice.
+    """
+
+    def __init__(self, rows):
+        ordered = sorted(rows, key=lambda row: (row[2], row[0]))
+        self.ids = [row[0] for row in ordered]
+        self.names = [row[2] for row in ordered]
+        self.texts = [(row[1].lower(), row[2].lower()) for row in ordered]
+        grams: Dict[str, array] = {}
+        for position, (symbol, name) in enumerate(self.texts):
+            for gram in {text[i:i + n] for text in (symbol, name) for n in (1, 2, 3) for i in range(len(text) - n + 1)}:
+                posting = grams.get(gram)
+                if posting is None:
+                    posting = grams[gram] = array("i")
+                posting.append(position)
+        self.grams = grams
+        self._ranked: Dict[str, tuple] = {}
+        for gram in [gram for gram in grams if len(gram) == 1]:
+            self.ranked(gram)
+
+    def ranked(self, term: str) -> tuple:
+        """(keys, coin ids) of the coins matching `term`, in ascending key order.
+
+        Keys are (rank, coinName); ranks are exact symbol, then name prefix,
+        then name substring, then symbol-only matches.
+        """
+        hit = self._ranked.get(term)
+        if hit is not None:
+            return hit
+        if len(term) <= 3:
+            candidates = self.grams.get(term, ())
+        else:
+            candidates = min((self.grams.get(term[i:i + 3], ()) for i in range(len(term) - 2)), key=len)
+        buckets = ([], [], [], [])
+        for position in candidates:
+            symbol, name = self.texts[position]
+            if symbol == term:
+                buckets[0].append(position)
+            elif name.startswith(term):
+                buckets[1].append(position)
+            elif term in name:
+                buckets[2].append(position)
+            elif term in symbol:
+                buckets[3].append(position)
+        keys, ids = [], []
+        for rank, positions in enumerate(buckets):
+            keys += [(rank, self.names[position]) for position in positions]
+            ids += [self.ids[position] for position in positions]
+        if len(self._ranked) >= SEARCH_CACHE_SIZE:
+            del self._ranked[next(iter(self._ranked))]
+        self._ranked[term] = keys, ids
+        return keys, ids
+
+class CoinCatalog:
+    """Memory-resident copy of the coins table keyed by id, symbol and name.
+
+    Triggers on `coins` bump `catalog_version`; the catalog reloads when that
+    counter moves, either on `invalidate()` from an in-process writer or from
+    the background poll that picks up changes made by other processes.
+    """
+
+    def __init__(self, db: Database, poll_interval: float):
+        self.db = db
+        self.poll_interval = poll_interval
+        self.by_id: Dict[int, dict] = {}
+        self.by_symbol: Dict[str, dict] = {}
+        self.by_name: Dict[str, dict] = {}
+        self.search: CoinSearch = CoinSearch([])
+        self.version = None
+        self.etag = None
+        self._task: asyncio.Task = None
+
+    @staticmethod
+    def _version(conn):
+        return conn.execute("SELECT version FROM catalog_version").fetchone()[0]
+
+    @staticmethod
+    def _load(conn):
+        version = CoinCatalog._version(conn)
+        return version, conn.execute("SELECT id, coinSymbol, coinName, imageUrl FROM coins ORDER BY id").fetchall()
+
+    def _build(self, version, rows, search: CoinSearch):
+        by_id, by_symbol, by_name = {}, {}, {}
+        digest = hashlib.sha1()
+        for coin_id, symbol, name, image_url in rows:
+            coin = {"id": coin_id, "coinSymbol": symbol.upper() + "USDT", "coinName": name, "imageUrl": image_url}
+            by_id[coin_id] = coin
+            # Lowest id wins when symbols collide, as the old LIMIT-less lookup returned
+            by_symbol.setdefault(symbol.lower(), coin)
+            by_name.setdefault(name.lower(), coin)
+            digest.update(f"{coin_id}\x1f{symbol}\x1f{name}\x1f{image_url}\x1e".encode())
+        self.by_id, self.by_symbol, self.by_name, self.search = by_id, by_symbol, by_name, search
+        self.version = version
+        self.etag = f'"{digest.hexdigest()}"'
+
+    async def refresh(self):
+        version, rows = await self.db.run(self._load)
+        # Indexing a large catalog takes a while, so it happens off the event loop
+        search = await asyncio.get_running_loop().run_in_executor(None, CoinSearch, rows)
+        self._build(version, rows, search)
+
+    async def invalidate(self):
+        """Reload if the coins table changed since the last build."""
+        if await self.db.run(self._version) != self.version:
+            await self.refresh()
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await self.invalidate()
+            except Exception as e:
+                log.warning("⚠️ Coin catalog refresh failed: %s", e)
+
+    async def start(self):
+        await self.refresh()
+        self._task = asyncio.create_task(self._poll())
+
+    async def stop(self):
+        self._task.cancel()
+
+    def cache_headers(self) -> Dict[str, str]:
+        return {"ETag": self.etag, "Cache-Control": f"public, max-age={CATALOG_MAX_AGE}"}
+
+catalog = CoinCatalog(db, CATALOG_POLL_INTERVAL)
+
+class BybitPriceFeed:
+    """Polls every spot ticker from Bybit in one request per interval."""
+
+    def __init__(self, url: str, interval: float):
+        self.url = url
+        self.interval = interval
+
+    def _fetch(self):
+        with urllib.request.urlopen(self.url, timeout=10) as response:
+            return json.load(response)
+
+    async def ticks(self):
+        loop = asyncio.get_running_loop()
+        delay = self.interval
+        while True:
+            try:
+                data = await loop.run_in_executor(None, self._fetch)
+                timestamp = int(data["time"])
+                ticks = [(item["symbol"], float(item["lastPrice"]), timestamp) for item in data["result"]["list"]]
+                delay = self.interval
+            except Exception as e:
+                log.warning("⚠️ Price feed error: %s", e)
+                ticks = None
+                delay = min(delay * 2, 60)  # back off while upstream is unreachable
+            if ticks:
+                yield ticks
+            await asyncio.sleep(delay)
+
+class ReplayPriceFeed:
+    """Replays recorded ticks from an NDJSON file of {"symbol", "price", "timestamp" (ms)} lines.
+
+    Ticks sharing a timestamp are published together and the gaps between
+    timestamps are slept through, divided by `speed`.
+    """
+
+    def __init__(self, path: str, speed: float = 1.0, repeat: bool = False):
+        self.path = path
+        self.speed = speed
+        self.repeat = repeat
+
+    def _read(self):
+        with open(self.path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    async def ticks(self):
+        while True:
+            batch, previous = [], None
+            for row in self._read():
+                timestamp = int(row["timestamp"])
+                if previous is not None and timestamp != previous:
+                    yield batch
+                    batch = []
+                    await asyncio.sleep(max(0, timestamp - previous) / 1000 / self.speed)
+                batch.append((row["symbol"].upper(), float(row["price"]), timestamp))
+                previous = timestamp
+            if batch:
+                yield batch
+            if not self.repeat:
+                return
+
+def make_price_feed(spec: str):
+    if spec == "none":
+        return None
+    if spec == "bybit":
+        return BybitPriceFeed(BYBIT_TICKERS_URL, PRICE_POLL_INTERVAL)
+    if spec.startswith("replay:"):
+        return ReplayPriceFeed(spec[len("replay:"):])
+    raise ValueError(f"Unknown price feed {spec!r}")
+
+class PriceSubscriber:
+    """One /ws/prices client. Pending ticks are conflated per symbol until sent.
+
+    All frames, error replies included, go out through `drain`, so the socket
+    has a single writer. A send that stalls for SEND_TIMEOUT closes it.
+    """
+
+    def __init__(self):
+        self.symbols = set()
+        self.pending: Dict[str, dict] = {}
+        self.errors: List[str] = []
+        self.ready = asyncio.Event()
+
+    def push(self, tick: dict):
+        self.pending[tick["symbol"]] = tick
+        self.ready.set()
+
+    def error(self, message: str):
+        self.errors.append(message)
+        self.ready.set()
+
+    async def drain(self, websocket: WebSocket):
+        try:
+            while True:
+                await self.ready.wait()
+                self.ready.clear()
+                frames = [{"error": message} for message in self.errors]
+                self.errors.clear()
+                if self.pending:
+                    frames.append({"prices": list(self.pending.values())})
+                    self.pending.clear()
+                for frame in frames:
+                    await asyncio.wait_for(websocket.send_json(frame), SEND_TIMEOUT)
+        except asyncio.TimeoutError:
+            log.info("✂️ Closing price stream: stalled")
+            try:
+                await asyncio.wait_for(websocket.close(1013), SEND_TIMEOUT)
+            except Exception:
+                pass
+        except Exception as e:
+            log.warning("⚠️ Price stream send error: %s", e)
+
+class PriceHub:
+    """Latest price per symbol from a single upstream feed, fanned out to subscribers.
+
+    `listeners` are called with every batch of raw ticks, unchanged prices included.
+    """
+
+    def __init__(self, feed):
+        self.feed = feed
+        self.latest: Dict[str, dict] = {}
+        self.listeners = []
+        self._by_symbol: Dict[str, set] = {}
+        self._everything = set()
+        self._task: asyncio.Task = None
+
+    async def start(self):
+        if self.feed is not None:
+            self._task = asyncio.create_task(self._ingest())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _ingest(self):
+        async for ticks in self.feed.ticks():
+            self.publish(ticks)
+            for listener in self.listeners:
+                listener(ticks)
+
+    def subscriber_count(self) -> int:
+        return len(self._everything.union(*self._by_symbol.values()))
+
+    def publish(self, ticks):
+        for symbol, price, timestamp in ticks:
+            current = self.latest.get(symbol)
+            if current is not None and current["price"] == price:
+                continue
+            tick = {"symbol": symbol, "price": price, "timestamp": timestamp}
+            self.latest[symbol] = tick
+            for subscriber in self._by_symbol.get(symbol, ()):
+                subscriber.push(tick)
+            for subscriber in self._everything:
+                subscriber.push(tick)
+
+    def subscribe(self, subscriber: PriceSubscriber, symbols: List[str]):
+        """Subscribe to `symbols` ("*" for all) and queue their current prices."""
+        for symbol in symbols:
+            symbol = symbol.upper()
+            if symbol == "*":
+                self._everything.add(subscriber)
+                for tick in self.latest.values():
+                    subscriber.push(tick)
+                continue
+            subscriber.symbols.add(symbol)
+            self._by_symbol.setdefault(symbol, set()).add(subscriber)
+            if symbol in self.latest:
+                subscriber.push(self.latest[symbol])
+
+    def unsubscribe(self, subscriber: PriceSubscriber, symbols: List[str] = None):
+        """Drop `symbols`, or every subscription when none are given."""
+        if symbols is None or "*" in symbols:
+            self._everything.discard(subscriber)
+        for symbol in (subscriber.symbols.copy() if symbols is None else {s.upper() for s in symbols}):
+            subscriber.symbols.discard(symbol)
+            subscribers = self._by_symbol.get(symbol)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._by_symbol[symbol]
+
+price_hub = PriceHub(make_price_feed(PRICE_FEED))
+
+CANDLE = struct.Struct("<qddddq")  # open time (ms), open, high, low, close, ticks
+CANDLE_DTYPE = np.dtype([("time", "<i8"), ("open", "<f8"), ("high", "<f8"), ("low", "<f8"), ("close", "<f8"),
+                         ("volume", "<i8")]) if np else None
+INTERVAL_UNITS = {"m": 60_000, "h": 3_600_000, "d": 86_400_000, "w": 604_800_000}
+
+def parse_interval(interval: str) -> int:
+    """Width in ms of "15m"/"4h"/"1d"/"1w" or Bybit's "15"/"240"/"D"/"W"."""
+    text = interval.strip().lower()
+    if text in ("d", "w"):
+        return INTERVAL_UNITS[text]
+    if text.isdigit():
+        width = int(text) * INTERVAL_UNITS["m"]
+    elif text[:-1].isdigit() and text[-1:] in INTERVAL_UNITS:
+        width = int(text[:-1]) * INTERVAL_UNITS[text[-1]]
+    else:
+        width = 0
+    if width <= 0:
+        raise HTTPException(status_code=400, detail=f"Invalid interval {interval!r}")
+    return width
+
+class CandleStore:
+    """OHLC candles rolled up from price ticks, one append-only file per interval and symbol.
 
-app = FastAPI()
+    Every tick updates the open candle of each stored interval in memory.
+    Candles are kept in `<directory>/<interval>/<SYMBOL>.bin` as fixed-size
+    records: appended once a later tick opens the next bucket, and rewritten
+    in place every `flush_interval` while still open. Records are sorted by
+    open time, so a range is located by binary search over the memory-mapped
+    file and copied out in a single slice.
+
+    Only the process holding the directory's lock file records candles. With
+    several uvicorn workers the others serve /history from the files, open
+    candles included thanks to the periodic rewrite, and one of them takes
+    the lock over if the writer exits. Writes go through a single writer
+    thread in order, as do reads in the writing process (elsewhere they use the
+    default executor), so a read sees every candle closed before it and file
+    I/O never runs on the event loop.
+
+    The ticker feeds carry no trades, so "volume" is the number of ticks.
+    """
+
+    def __init__(self, directory: str, intervals: Dict[str, int], flush_interval: float):
+        self.directory = directory
+        self.intervals = intervals
+        self.flush_interval = flush_interval
+        # (interval, symbol) → [open time, open, high, low, close, ticks, already on disk]
+        self._open: Dict[tuple, list] = {}
+        self._dirty = set()
+        self._lock_file = None
+        self._writer: ThreadPoolExecutor = None
+        self._task: asyncio.Task = None
+
+    def _path(self, interval: str, symbol: str) -> str:
+        return os.path.join(self.directory, interval, f"{symbol}.bin")
+
+    @property
+    def writing(self) -> bool:
+        return self._lock_file is not None
+
+    def _acquire(self):
+        """The writer lock file if this process could take it without waiting, else None."""
+        os.makedirs(self.directory, exist_ok=True)
+        lock_file = open(os.path.join(self.directory, ".writer.lock"), "a")
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return None
+        return lock_file
+
+    def _load_open(self) -> Dict[tuple, list]:
+        """The last stored candle of every file, to be continued if ticks resume in its bucket."""
+        loaded = {}
+        for interval in self.intervals:
+            folder = os.path.join(self.directory, interval)
+            for name in os.listdir(folder) if os.path.isdir(folder) else ():
+                if not name.endswith(".bin"):
+                    continue
+                with open(os.path.join(folder, name), "rb") as f:
+                    size = os.fstat(f.fileno()).st_size // CANDLE.size * CANDLE.size
+                    if size:
+                        f.seek(size - CANDLE.size)
+                        loaded[interval, name[:-len(".bin")]] = [*CANDLE.unpack(f.read(CANDLE.size)), True]
+        return loaded
+
+    async def _take_over(self):
+        loop = asyncio.get_running_loop()
+        lock_file = await loop.run_in_executor(None, self._acquire)
+        if lock_file is None:
+            return
+        self._open = await loop.run_in_executor(None, self._load_open)
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="candles")
+        self._lock_file = lock_file
+        log.info("🕯️ Recording candles in %s", self.directory)
+
+    async def start(self):
+        try:
+            # Before the feed starts, so its first ticks are recorded
+            await self._take_over()
+        except OSError as e:
+            log.warning("⚠️ Candle store error: %s", e)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        if self.writing:
+            self.flush()
+            await asyncio.get_running_loop().run_in_executor(None, self._writer.shutdown)
+            self._writer = None
+            self._lock_file.close()
+            self._lock_file = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                if self.writing:
+                    self.flush()
+                else:
+                    await self._take_over()
+            except OSError as e:
+                log.warning("⚠️ Candle store error: %s", e)
+
+    def record(self, ticks):
+        if not self.writing:
+            return
+        for symbol, price, timestamp in ticks:
+            for interval, width in self.intervals.items():
+                start = timestamp - timestamp % width
+                key = (interval, symbol)
+                candle = self._open.get(key)
+                if candle is not None and start > candle[0]:
+                    self._persist(key, candle)
+                    candle = None
+                if candle is None:
+                    candle = self._open[key] = [start, price, price, price, price, 0, False]
+                elif start < candle[0]:
+                    continue  # late tick for a bucket that is already closed
+                if price > candle[2]:
+                    candle[2] = price
+                if price < candle[3]:
+                    candle[3] = price
+                candle[4] = price
+                candle[5] += 1
+                self._dirty.add(key)
+
+    def _persist(self, key: tuple, candle: list):
+        interval, symbol = key
+        self._writer.submit(self._write, self._path(interval, symbol), CANDLE.pack(*candle[:6]), candle[6], interval)
+        candle[6] = True
+
+    @staticmethod
+    def _write(path: str, record: bytes, overwrite: bool, interval: str):
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "r+b" if overwrite else "ab") as f:
+                if overwrite:
+                    f.seek(-CANDLE.size, os.SEEK_END)
+                f.write(record)
+            candles_written.inc(interval)
+        except OSError as e:
+            log.warning("⚠️ Candle write failed for %s: %s", path, e)
+
+    def flush(self):
+        """Queue a write of every open candle that changed since the last flush."""
+        for key in self._dirty:
+            self._persist(key, self._open[key])
+        self._dirty.clear()
+
+    def _known(self, symbol: str) -> bool:
+        return any((interval, symbol) in self._open or os.path.exists(self._path(interval, symbol))
+                   for interval in self.intervals)
+
+    def _resolve(self, symbol: str) -> str:
+        if not self._known(symbol) and self._known(f"{symbol}USDT"):
+            return f"{symbol}USDT"
+        return symbol
+
+    async def resolve(self, symbol: str) -> str:
+        """`symbol`, or `symbol`USDT when only that one has candles."""
+        return await asyncio.get_running_loop().run_in_executor(None, self._resolve, symbol)
+
+    def _read(self, interval: str, symbol: str, start: int, end: int) -> bytes:
+        """Stored records with start <= open time < end."""
+        try:
+            f = open(self._path(interval, symbol), "rb")
+        except FileNotFoundError:
+            return b""
+        with f:
+            count = os.fstat(f.fileno()).st_size // CANDLE.size
+            if not count:
+                return b""
+            with mmap.mmap(f.fileno(), count * CANDLE.size, access=mmap.ACCESS_READ) as view:
+                def first_at(time_ms):
+                    lo, hi = 0, count
+                    while lo < hi:
+                        mid = (lo + hi) // 2
+                        if CANDLE.unpack_from(view, mid * CANDLE.size)[0] < time_ms:
+                            lo = mid + 1
+                        else:
+                            hi = mid
+                    return lo
+
+                return view[first_at(start) * CANDLE.size:first_at(end) * CANDLE.size]
+
+    def _range(self, interval: str, symbol: str, start: int, end: int, bucket: int, live) -> List[dict]:
+        data = self._read(interval, symbol, start, end)
+        if live is not None and data and CANDLE.unpack_from(data, len(data) - CANDLE.size)[0] == live[0]:
+            data = data[:-CANDLE.size]  # the in-memory candle is newer than its flushed copy
+        if live is not None and start <= live[0] < end:
+            data += CANDLE.pack(*live)
+        if not data:
+            return []
+        if np is not None:
+            rows = np.frombuffer(data, dtype=CANDLE_DTYPE)
+            groups = rows["time"] // bucket
+            starts = np.concatenate(([0], np.flatnonzero(np.diff(groups)) + 1))
+            ends = np.append(starts[1:], len(rows)) - 1
+            return [{"time": int(time_ms), "open": o, "high": h, "low": l, "close": c, "volume": int(v)}
+                    for time_ms, o, h, l, c, v in zip((groups[starts] * bucket).tolist(), rows["open"][starts].tolist(),
+                                                      np.maximum.reduceat(rows["high"], starts).tolist(),
+                                                      np.minimum.reduceat(rows["low"], starts).tolist(),
+                                                      rows["close"][ends].tolist(),
+                                                      np.add.reduceat(rows["volume"], starts).tolist())]
+        candles = []
+        for time_ms, o, h, l, c, v in CANDLE.iter_unpack(data):
+            time_ms -= time_ms % bucket
+            if candles and candles[-1]["time"] == time_ms:
+                merged = candles[-1]
+                merged["high"] = max(merged["high"], h)
+                merged["low"] = min(merged["low"], l)
+                merged["close"] = c
+                merged["volume"] += v
+            else:
+                candles.append({"time": time_ms, "open": o, "high": h, "low": l, "close": c, "volume": v})
+        return candles
+
+    async def history(self, symbol: str, width: int, start: int, end: int, points: int) -> tuple:
+        """(bucket width in ms, candles) for [start, end), merged down to at most `points` candles.
+
+        Reads the coarsest stored interval that fits the bucket, so a year of
+        history is read from hourly or daily records rather than minutes.
+        """
+        bucket = max(width, -(-(end - start) // points))
+        interval = max((name for name, size in self.intervals.items() if size <= bucket),
+                       key=self.intervals.get, default=min(self.intervals, key=self.intervals.get))
+        base = self.intervals[interval]
+        bucket = -(-bucket // base) * base
+        live = self._open.get((interval, symbol))
+        live = tuple(live[:6]) if live is not None else None
+        loop = asyncio.get_running_loop()
+        # Queued behind pending writes when this process writes, so every closed candle is on disk
+        candles = await loop.run_in_executor(self._writer, self._range, interval, symbol, start - start % bucket, end, bucket, live)
+        return bucket, candles
+
+candles = CandleStore(CANDLE_DIR, CANDLE_INTERVALS, CANDLE_FLUSH_INTERVAL)
+price_hub.listeners.append(candles.record)
+
+class PortfolioEngine:
+    """Values holdings against the live price table.
+
+    Holdings are cached per user until a local write calls `invalidate` or
+    they are older than `holdings_ttl`. Valuations are cached alongside the
+    prices they used and recomputed once any of those prices moves by more
+    than `tolerance`. Many portfolios are valued in one vectorized pass.
+    """
+
+    def __init__(self, db: Database, catalog: CoinCatalog, prices: PriceHub, tolerance: float, holdings_ttl: float):
+        self.db = db
+        self.catalog = catalog
+        self.prices = prices
+        self.tolerance = tolerance
+        self.holdings_ttl = holdings_ttl
+        self._holdings: Dict[str, tuple] = {}    # username -> (loaded_at, coin_ids, quantities)
+        self._valuations: Dict[str, tuple] = {}  # username -> (prices used, result)
+
+    def invalidate(self, *usernames: str):
+        for username in usernames:
+            self._holdings.pop(username, None)
+            self._valuations.pop(username, None)
+
+    @staticmethod
+    def _load(conn, usernames: List[str]):
+        names = json.dumps(usernames)
+        known = {row[0] for row in conn.execute(
+            "SELECT username FROM users WHERE username IN (SELECT value FROM json_each(?))", (names,))}
+        rows = conn.execute('''SELECT u.username, uc.coin_id, uc.quantity
+                                FROM users u JOIN user_coins uc ON uc.user_id = u.id
+                                WHERE u.username IN (SELECT value FROM json_each(?))''', (names,)).fetchall()
+        return known, rows
+
+    def _price(self, coin_id: int):
+        coin = self.catalog.by_id.get(coin_id)
+        tick = self.prices.latest.get(coin["coinSymbol"]) if coin else None
+        return tick["price"] if tick else None
+
+    def _moved(self, used, current) -> bool:
+        for old, new in zip(used, current):
+            if (old is None) != (new is None):
+                return True
+            if old is not None and abs(new - old) > self.tolerance * abs(old):
+                return True
+        return False
+
+    def _valuate(self, portfolios):
+        """Value [(username, coin_ids, quantities, prices)] with one multiply-and-sum."""
+        owners, quantities, prices = [], [], []
+        for index, (_, coin_ids, user_quantities, user_prices) in enumerate(portfolios):
+            owners.extend([index] * len(coin_ids))
+            quantities.extend(user_quantities)
+            prices.extend(0.0 if price is None else price for price in user_prices)
+        if np is not None:
+            values = np.asarray(quantities, dtype=float) * np.asarray(prices, dtype=float)
+            totals = np.bincount(np.asarray(owners, dtype=np.intp), weights=values, minlength=len(portfolios)).tolist()
+            values = values.tolist()
+        else:
+            values = [quantity * price for quantity, price in zip(quantities, prices)]
+            totals = [0.0] * len(portfolios)
+            for owner, value in zip(owners, values):
+                totals[owner] += value
+
+        results, offset = [], 0
+        for index, (username, coin_ids, user_quantities, user_prices) in enumerate(portfolios):
+            holdings = []
+            for coin_id, quantity, price, value in zip(coin_ids, user_quantities, user_prices, values[offset:]):
+                holdings.append({"coin": self.catalog.by_id.get(coin_id), "quantity": quantity,
+                                 "price": price, "value": value if price is not None else None})
+            offset += len(coin_ids)
+            results.append({"username": username, "total": totals[index], "holdings": holdings})
+        return results
+
+    async def value(self, usernames: List[str]) -> Dict[str, dict]:
+        """Portfolio per username; unknown users map to None."""
+        now = time.monotonic()
+        stale = [u for u in usernames if u not in self._holdings or now - self._holdings[u][0] > self.holdings_ttl]
+        if stale:
+            known, rows = await self.db.run(self._load, stale)
+            loaded = {username: ([], []) for username in known}
+            for username, coin_id, quantity in rows:
+                loaded[username][0].append(coin_id)
+                loaded[username][1].append(quantity)
+            if any(coin_id not in self.catalog.by_id for _, coin_id, _ in rows):
+                await self.catalog.invalidate()
+            for username in stale:
+                self.invalidate(username)
+                if username in loaded:
+                    self._holdings[username] = (now, *loaded[username])
+
+        results, pending = {}, []
+        for username in usernames:
+            if username not in self._holdings:
+                results[username] = None
+                continue
+            _, coin_ids, quantities = self._holdings[username]
+            current = [self._price(coin_id) for coin_id in coin_ids]
+            cached = self._valuations.get(username)
+            if cached is not None and not self._moved(cached[0], current):
+                results[username] = cached[1]
+            else:
+                pending.append((username, coin_ids, quantities, current))
+        if pending:
+            for (username, _, _, used), result in zip(pending, self._valuate(pending)):
+                self._valuations[username] = (used, result)
+                results[username] = result
+        return results
+
+portfolio = PortfolioEngine(db, catalog, price_hub, PORTFOLIO_PRICE_TOLERANCE, PORTFOLIO_HOLDINGS_TTL)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    log_listener.start()
+    chat_writer.start()
+    await catalog.start()
+    await candles.start()
+    await price_hub.start()
+    await router.start()
+    yield
+    await router.stop()
+    await price_hub.stop()
+    await candles.stop()
+    await catalog.stop()
+    await chat_writer.stop()
+    db.close()
+    log_listener.stop()
+
+def dumps(content) -> bytes:
+    if orjson:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode()
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson when it is installed.
+
+    Hot list endpoints return one of these directly, which also skips FastAPI's
+    jsonable_encoder pass and response_model revalidation of rows that are
+    already plain dicts.
+    """
+
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+class MetricsMiddleware:
+    """Times every HTTP request, labelled by the route template it matched."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        status = 500
+
+        async def send_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            # The router records the matched route in the shared scope
+            route = scope.get("route")
+            http_duration.observe(time.perf_counter() - started, scope["method"],
+                                  route.path if route is not None else "unmatched", status)
+
+app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
+app.add_middleware(MetricsMiddleware)
 
 class User(BaseModel): #add_usr
     email: str
@@ -24,13 +1204,36 @@ class UserHoldings(BaseModel):
     coin: CoinDetails
     quantity: float
 
+class TradeOrder(BaseModel):
+    username: str
+    coin_id: int
+    quantity: float
+    side: Literal["buy", "sell"]
+
+class TradeBatch(BaseModel):
+    orders: List[TradeOrder]
+    atomic: bool = True  # all-or-nothing; False applies what it can and reports per order
+
+class PortfolioBatch(BaseModel):
+    usernames: List[str]
+    details: bool = False  # include per-coin holdings, not just totals
+
 def init_db():
-    with sqlite3.connect("chat.db") as conn:
+    conn = db.connect()
+    with conn:
         # conn.execute('drop table users')
         conn.execute('''CREATE TABLE IF NOT EXISTS users 
                        (id INTEGER PRIMARY KEY, email TEXT UNIQUE, username TEXT UNIQUE, password TEXT, profilePicture TEXT)''')
         
         conn.execute("CREATE TABLE IF NOT EXISTS coins (id INTEGER PRIMARY KEY, coinName TEXT UNIQUE, coinSymbol TEXT, imageUrl TEXT)")
+
+        # Change counter for the in-memory coin catalog
+        conn.execute("CREATE TABLE IF NOT EXISTS catalog_version (id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER NOT NULL)")
+        conn.execute("INSERT OR IGNORE INTO catalog_version (id, version) VALUES (1, 0)")
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            conn.execute(f'''CREATE TRIGGER IF NOT EXISTS coins_version_{event.lower()} AFTER {event} ON coins BEGIN
+                                UPDATE catalog_version SET version = version + 1;
+                            END''')
         
         conn.execute('''CREATE TABLE IF NOT EXISTS user_coins
                 (id INTEGER PRIMARY KEY,
@@ -41,51 +1244,76 @@ def init_db():
                 FOREIGN KEY(user_id) REFERENCES users(id),
                 FOREIGN KEY(coin_id) REFERENCES coins(id))''')
 
+        # Collapse duplicate holdings rows so (user_id, coin_id) can be unique
+        conn.execute('''UPDATE user_coins
+                        SET quantity = (SELECT SUM(d.quantity) FROM user_coins d
+                                        WHERE d.user_id = user_coins.user_id AND d.coin_id = user_coins.coin_id)
+                        WHERE id IN (SELECT MIN(id) FROM user_coins GROUP BY user_id, coin_id HAVING COUNT(*) > 1)''')
+        conn.execute("DELETE FROM user_coins WHERE id NOT IN (SELECT MIN(id) FROM user_coins GROUP BY user_id, coin_id)")
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_user_coins_user_coin ON user_coins (user_id, coin_id)")
+
+        conn.execute('''CREATE TABLE IF NOT EXISTS transfers
+                (id INTEGER PRIMARY KEY,
+                idempotency_key TEXT UNIQUE,
+                from_user_id INTEGER,
+                to_user_id INTEGER,
+                coin_id INTEGER,
+                amount REAL,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)''')
+
+        # Append-only journal of every balance change; user_coins holds the running totals
+        conn.execute('''CREATE TABLE IF NOT EXISTS ledger
+                (id INTEGER PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                coin_id INTEGER NOT NULL,
+                delta REAL NOT NULL,
+                kind TEXT NOT NULL,
+                transfer_id INTEGER,
+                timestamp REAL NOT NULL)''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_ledger_user_coin_time ON ledger (user_id, coin_id, timestamp)")
+        if not conn.execute("SELECT 1 FROM ledger LIMIT 1").fetchone():
+            # Open the journal with the balances that predate it
+            conn.execute('''INSERT INTO ledger (user_id, coin_id, delta, kind, timestamp)
+                            SELECT user_id, coin_id, quantity, 'opening', COALESCE(CAST(strftime('%s', timestamp) AS REAL), 0)
+                            FROM user_coins WHERE quantity != 0''')
+
         conn.execute('''CREATE TABLE IF NOT EXISTS chats 
                        (id INTEGER PRIMARY KEY, from_user TEXT, to_user TEXT, message TEXT, timestamp INTEGER)''')
+        # A conversation is read through both directions of the (sender, recipient) key
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_chats_from_to_time ON chats (from_user, to_user, timestamp)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_chats_to_from_time ON chats (to_user, from_user, timestamp)")
+
+        # Per-recipient delivery sequence and the messages each user has not acked yet
+        conn.execute("CREATE TABLE IF NOT EXISTS delivery_seq (username TEXT PRIMARY KEY, last_seq INTEGER NOT NULL)")
+        conn.execute('''CREATE TABLE IF NOT EXISTS pending_deliveries
+                        (username TEXT, seq INTEGER, chat_id INTEGER, PRIMARY KEY (username, seq)) WITHOUT ROWID''')
+    conn.close()
 
 init_db()
     
 @app.get("/userholdings/{username}", response_model=List[UserHoldings])
 async def get_wallet_details(username: str):
-    with sqlite3.connect("chat.db") as conn:
+    def query(conn):
         cursor = conn.cursor()
         
-        # Get user email
-        cursor.execute("SELECT email FROM users WHERE username = ?", (username,))
-        user_email = cursor.fetchone()
-        if not user_email:
+        # Get user email and id
+        cursor.execute("SELECT email, id FROM users WHERE username = ?", (username,))
+        user = cursor.fetchone()
+        if not user:
             raise HTTPException(status_code=404, detail="User mail not found")
         
-        # Get wallet details
-        # First get user_id from username
-        cursor.execute("SELECT id FROM users WHERE username = ?", (username,))
-        user_id = cursor.fetchone()
-        if not user_id:
-            raise HTTPException(status_code=404, detail="User id not found")
-        
-        cursor.execute('''SELECT 
-                            c.id AS coin_id,
-                            c.coinSymbol,
-                            c.coinName,
-                            c.imageUrl,
-                            SUM(uc.quantity) AS total_quantity
-                        FROM user_coins uc
-                        JOIN coins c ON uc.coin_id = c.id
-                        WHERE uc.user_id = ?
-                        GROUP BY c.id, c.coinSymbol, c.coinName, c.imageUrl''', (user_id[0],))
-        rows = cursor.fetchall()
-        
-        return [UserHoldings(
-            email=user_email[0],
-            coin=CoinDetails(
-                id=row[0],
-                coinSymbol=row[1].upper() + "USDT",
-                coinName=row[2],
-                imageUrl=row[3]
-            ),
-            quantity=row[4],
-        ) for row in rows]
+        # Coin details come from the catalog, so only the holdings are read here
+        cursor.execute("SELECT coin_id, quantity FROM user_coins WHERE user_id = ?", (user[1],))
+        return user[0], cursor.fetchall()
+
+    email, rows = await db.run(query)
+    if any(row[0] not in catalog.by_id for row in rows):
+        await catalog.invalidate()
+
+    # Catalog entries are already in CoinDetails shape and are shared, not copied
+    by_id = catalog.by_id
+    return FastJSONResponse([{"email": email, "coin": by_id[coin_id], "quantity": quantity}
+                             for coin_id, quantity in rows if coin_id in by_id])
 
 @app.get("/")
 async def index():
@@ -93,394 +1321,1378 @@ async def index():
 
 @app.post("/add_user")
 async def add_user(user: User):
+    def insert(conn):
+        cursor = conn.cursor()
+        # Insert new user
+        cursor.execute("INSERT INTO users (email, username, password, profilePicture) VALUES (?, ?, ?, ?)", 
+                     (user.email, user.username, user.password, user.profilePicture))
+
     try:
-        with sqlite3.connect("chat.db") as conn:
-            cursor = conn.cursor()
-            # Insert new user
-            cursor.execute("INSERT INTO users (email, username, password, profilePicture) VALUES (?, ?, ?, ?)", 
-                         (user.email, user.username, user.password, user.profilePicture))
-            conn.commit()
-            print("👤 User added:", user.email, user.username)
-            return {"id": user.email}
+        await db.write(insert)
+        log.info("👤 User added: %s %s", user.email, user.username)
+        return {"id": user.email}
     except sqlite3.IntegrityError:
         raise HTTPException(status_code=400, detail="Email or username exists")
 
-@app.get("/get_users", response_model=List[User])
-async def get_all_users():
-    with sqlite3.connect("chat.db") as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT email, username, password, profilePicture FROM users")
-        return [{"email": row[0], "username": row[1], "password": row[2], "profilePicture": row[3]} 
-                for row in cursor.fetchall()]
-    
+def trade_not_applied(cursor, username: str, coin_id: int):
+    """Explain why a ledger statement touched no rows."""
+    cursor.execute("SELECT id FROM users WHERE username = ?", (username,))
+    if not cursor.fetchone():
+        return HTTPException(status_code=404, detail="User not found")
+    cursor.execute("SELECT id FROM coins WHERE id = ?", (coin_id,))
+    if not cursor.fetchone():
+        return HTTPException(status_code=404, detail="Coin not found")
+    return HTTPException(status_code=400, detail="Insufficient balance")
+
+def journal(cursor, entries):
+    """Append (user_id, coin_id, delta, kind, transfer_id) entries to the ledger."""
+    now = time.time()
+    cursor.executemany("INSERT INTO ledger (user_id, coin_id, delta, kind, transfer_id, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
+                       [(*entry, now) for entry in entries])
+
+def journal_trade(cursor, username: str, coin_id: int, delta: float, kind: str):
+    cursor.execute("INSERT INTO ledger (user_id, coin_id, delta, kind, timestamp) SELECT id, ?, ?, ?, ? FROM users WHERE username = ?",
+                   (coin_id, delta, kind, time.time(), username))
+
+def apply_buy(conn, username: str, coin_id: int, quantity: float):
+    cursor = conn.cursor()
+    # One upsert: resolves user and coin, then creates or tops up the holding
+    cursor.execute('''
+        INSERT INTO user_coins (user_id, coin_id, quantity)
+        SELECT u.id, c.id, ? FROM users u, coins c
+        WHERE u.username = ? AND c.id = ?
+        ON CONFLICT (user_id, coin_id) DO UPDATE SET quantity = quantity + excluded.quantity
+    ''', (quantity, username, coin_id))
+    if cursor.rowcount == 0:
+        raise trade_not_applied(cursor, username, coin_id)
+    journal_trade(cursor, username, coin_id, quantity, "buy")
+
+def apply_sell(conn, username: str, coin_id: int, quantity: float):
+    cursor = conn.cursor()
+    # Conditional debit: the balance check and the write are the same statement
+    cursor.execute('''
+        UPDATE user_coins
+        SET quantity = quantity - ?
+        WHERE user_id = (SELECT id FROM users WHERE username = ?) AND coin_id = ? AND quantity >= ?
+    ''', (quantity, username, coin_id, quantity))
+    if cursor.rowcount == 0:
+        raise trade_not_applied(cursor, username, coin_id)
+    journal_trade(cursor, username, coin_id, -quantity, "sell")
+
 @app.get("/buy_coin")
 async def buy_coin(username: str, coin_id: int, quantity: float):
-    print(quantity)
+    # Validate quantity
+    if quantity <= 0:
+        raise HTTPException(status_code=400, detail="Quantity must be positive")
+
     try:
-        with sqlite3.connect("chat.db") as conn:
-            cursor = conn.cursor()
-            
-            # First check if user exists
-            cursor.execute("SELECT id FROM users WHERE username = ?", (username,))
-            user = cursor.fetchone()
-            if not user:
-                raise HTTPException(status_code=404, detail="User not found")
-            
-            # Check if coin exists
-            cursor.execute("SELECT coinName FROM coins WHERE id = ?", (coin_id,))
-            coin = cursor.fetchone()
-            if not coin:
-                raise HTTPException(status_code=404, detail="Coin not found")
-            
-            # Validate quantity
-            if quantity <= 0:
-                raise HTTPException(status_code=400, detail="Quantity must be positive")
-            
-            # Get current balance of the user for this coin
-            cursor.execute('''
-                SELECT quantity 
-                FROM user_coins 
-                WHERE user_id = (SELECT id FROM users WHERE username = ?) AND coin_id = ?
-            ''', (username, coin_id))
-            balance = cursor.fetchone()
-            if not balance:
-                cursor.execute('''
-                    INSERT INTO user_coins (user_id, coin_id, quantity)
-                    VALUES ((SELECT id FROM users WHERE username = ?), ?, ?)
-                ''', (username, coin_id, quantity))
-            else:
-                cursor.execute('''
-                    UPDATE user_coins 
-                    SET quantity = quantity + ?
-                    WHERE user_id = (SELECT id FROM users WHERE username = ?) AND coin_id = ?
-                ''', (quantity, username, coin_id))
-            
-            conn.commit()
-            print(f"🪙 {username} bought {quantity} of coin {coin[0]}")
-            return {"status": "success", "message": f"Successfully bought {quantity} of coin {coin_id}"}
+        await db.write(apply_buy, username, coin_id, quantity)
+        portfolio.invalidate(username)
+        log.debug("🪙 %s bought %s of coin %s", username, quantity, coin_id)
+        return {"status": "success", "message": f"Successfully bought {quantity} of coin {coin_id}"}
             
+    except HTTPException:
+        raise
     except sqlite3.Error as e:
-        print(f"Database error: {e}")
+        log.error("Database error: %s", e)
         raise HTTPException(status_code=500, detail="Database error")
     except Exception as e:
-        print(f"Error: {e}")
+        log.error("Error: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/sell_coin")
 async def sell_coin(username: str, coin_id: int, quantity: float):
+    # Validate quantity
+    if quantity <= 0:
+        raise HTTPException(status_code=400, detail="Quantity must be positive")
+
     try:
-        with sqlite3.connect("chat.db") as conn:
-            cursor = conn.cursor()
-            
-            # First check if user exists
-            cursor.execute("SELECT id FROM users WHERE username = ?", (username,))
-            user = cursor.fetchone()
-            if not user:
-                raise HTTPException(status_code=404, detail="User not found")
-            
-            # Check if coin exists
-            cursor.execute("SELECT id FROM coins WHERE id = ?", (coin_id,))
-            coin = cursor.fetchone()
-            if not coin:
-                raise HTTPException(status_code=404, detail="Coin not found")
-            
-            # Validate quantity
-            if quantity <= 0:
-                raise HTTPException(status_code=400, detail="Quantity must be positive")
-            
-            # Get current balance of the user for this coin
-            cursor.execute('''
-                SELECT quantity 
-                FROM user_coins 
-                WHERE user_id = (SELECT id FROM users WHERE username = ?) AND coin_id = ?
-            ''', (username, coin_id))
-            balance = cursor.fetchone()
-            
-            if not balance or not balance[0] or float(balance[0]) < quantity:
-                raise HTTPException(status_code=400, detail="Insufficient balance")
-            
-            # Update user's balance by deducting the sold amount
-            cursor.execute('''
-                UPDATE user_coins 
-                SET quantity = quantity - ?
-                WHERE user_id = (SELECT id FROM users WHERE username = ?) AND coin_id = ?
-            ''', (quantity, username, coin_id))
-            
-            conn.commit()
-            print(f"🪙 {username} sold {quantity} of coin {coin_id}")
-            return {"status": "success", "message": f"Successfully sold {quantity} of coin {coin_id}"}
+        await db.write(apply_sell, username, coin_id, quantity)
+        portfolio.invalidate(username)
+        log.debug("🪙 %s sold %s of coin %s", username, quantity, coin_id)
+        return {"status": "success", "message": f"Successfully sold {quantity} of coin {coin_id}"}
             
+    except HTTPException:
+        raise
     except sqlite3.Error as e:
-        print(f"Database error: {e}")
+        log.error("Database error: %s", e)
         raise HTTPException(status_code=500, detail="Database error")
     except Exception as e:
-        print(f"Error: {e}")
+        log.error("Error: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
+def apply_batch_atomic(conn, orders: List[TradeOrder]):
+    """Net the orders per holding and apply them with grouped statements.
+
+    Orders are summed per (username, coin_id), so the batch succeeds when every
+    holding's final balance is non-negative, regardless of order within it.
+    """
+    cursor = conn.cursor()
+    deltas: Dict[tuple, float] = {}
+    first_index: Dict[tuple, int] = {}
+    for index, order in enumerate(orders):
+        key = (order.username, order.coin_id)
+        first_index.setdefault(key, index)
+        deltas[key] = deltas.get(key, 0.0) + (order.quantity if order.side == "buy" else -order.quantity)
+
+    cursor.execute("SELECT username, id FROM users WHERE username IN (SELECT value FROM json_each(?))",
+                   (json.dumps(list({username for username, _ in deltas})),))
+    user_ids = dict(cursor.fetchall())
+    cursor.execute("SELECT id FROM coins WHERE id IN (SELECT value FROM json_each(?))",
+                   (json.dumps(list({coin_id for _, coin_id in deltas})),))
+    coin_ids = {row[0] for row in cursor.fetchall()}
+    for (username, coin_id), index in first_index.items():
+        if username not in user_ids:
+            raise HTTPException(status_code=404, detail=f"Order {index}: User not found")
+        if coin_id not in coin_ids:
+            raise HTTPException(status_code=404, detail=f"Order {index}: Coin not found")
+
+    credits = [(user_ids[u], c, q) for (u, c), q in deltas.items() if q > 0]
+    debits = [(-q, user_ids[u], c, -q) for (u, c), q in deltas.items() if q < 0]
+
+    if debits:
+        cursor.execute('''SELECT user_id, coin_id, quantity FROM user_coins
+                          WHERE (user_id, coin_id) IN (SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]') FROM json_each(?))''',
+                       (json.dumps([[user_id, coin_id] for _, user_id, coin_id, _ in debits]),))
+        balances = {(row[0], row[1]): row[2] for row in cursor.fetchall()}
+        for (username, coin_id), quantity in deltas.items():
+            if quantity < 0 and (balances.get((user_ids[username], coin_id)) or 0) < -quantity:
+                raise HTTPException(status_code=400,
+                                    detail=f"Order {first_index[(username, coin_id)]}: Insufficient balance")
+        cursor.executemany('''UPDATE user_coins SET quantity = quantity - ?
+                              WHERE user_id = ? AND coin_id = ? AND quantity >= ?''', debits)
+        if cursor.rowcount != len(debits):
+            raise HTTPException(status_code=409, detail="Balances changed during batch")
+
+    cursor.executemany('''INSERT INTO user_coins (user_id, coin_id, quantity) VALUES (?, ?, ?)
+                          ON CONFLICT (user_id, coin_id) DO UPDATE SET quantity = quantity + excluded.quantity''',
+                       credits)
+    journal(cursor, [(user_ids[order.username], order.coin_id,
+                      order.quantity if order.side == "buy" else -order.quantity, order.side, None)
+                     for order in orders])
+    return [{"index": index, "status": "success"} for index in range(len(orders))]
+
+def apply_batch_best_effort(conn, orders: List[TradeOrder]):
+    """Apply orders one by one in a single transaction, recording each outcome."""
+    results = []
+    for index, order in enumerate(orders):
+        try:
+            if order.quantity <= 0:
+                raise HTTPException(status_code=400, detail="Quantity must be positive")
+            apply = apply_buy if order.side == "buy" else apply_sell
+            apply(conn, order.username, order.coin_id, order.quantity)
+            results.append({"index": index, "status": "success"})
+        except HTTPException as e:
+            results.append({"index": index, "status": "error", "status_code": e.status_code, "detail": e.detail})
+    return results
+
+@app.post("/trades/batch")
+async def trade_batch(batch: TradeBatch):
+    if batch.atomic:
+        for index, order in enumerate(batch.orders):
+            if order.quantity <= 0:
+                raise HTTPException(status_code=400, detail=f"Order {index}: Quantity must be positive")
+
+    try:
+        if batch.atomic:
+            results = await db.write(apply_batch_atomic, batch.orders)
+        else:
+            results = await db.write(apply_batch_best_effort, batch.orders)
+    except HTTPException:
+        raise
+    except sqlite3.Error as e:
+        log.error("Database error: %s", e)
+        raise HTTPException(status_code=500, detail="Database error")
+    finally:
+        portfolio.invalidate(*{order.username for order in batch.orders})
+
+    failed = sum(1 for result in results if result["status"] != "success")
+    log.debug("🪙 Applied batch of %d/%d orders", len(results) - failed, len(results))
+    return {"status": "success" if not failed else "partial", "results": results}
+
+# Bulk export/import. Every table is walked in id order one keyset page per
+# query, so memory stays flat and no read transaction is held between pages.
+EXPORT_TABLES = {
+    "users": ("SELECT id, email, username, password, profilePicture FROM users WHERE id > ? ORDER BY id LIMIT ?",
+              ("id", "email", "username", "password", "profilePicture")),
+    "coins": ("SELECT id, coinName, coinSymbol, imageUrl FROM coins WHERE id > ? ORDER BY id LIMIT ?",
+              ("id", "coinName", "coinSymbol", "imageUrl")),
+    "holdings": ('''SELECT uc.id, u.username, uc.coin_id, uc.quantity FROM user_coins uc
+                    JOIN users u ON u.id = uc.user_id WHERE uc.id > ? ORDER BY uc.id LIMIT ?''',
+                 ("id", "username", "coin_id", "quantity")),
+    "chats": ("SELECT id, from_user, to_user, message, timestamp FROM chats WHERE id > ? ORDER BY id LIMIT ?",
+              ("id", "from_user", "to_user", "message", "timestamp")),
+}
+PRIVATE_FIELDS = ("password",)  # never projected over HTTP; bulk.py reads the database itself
+EXPORT_CHUNK_SIZE = 2000
+IMPORT_BATCH_SIZE = 5000
+USERS_PAGE_MAX = 1000
+
+def projected_fields(table: str, fields: str, default: tuple) -> tuple:
+    """Validate a comma-separated `fields` projection against the table's columns."""
+    if fields is None:
+        return default
+    chosen = tuple(field.strip() for field in fields.split(",") if field.strip())
+    unknown = [field for field in chosen if field not in EXPORT_TABLES[table][1]]
+    if unknown or not chosen:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown) or fields}")
+    private = [field for field in chosen if field in PRIVATE_FIELDS]
+    if private:
+        raise HTTPException(status_code=400, detail=f"Fields not available: {', '.join(private)}")
+    return chosen
+
+def export_page(conn, table: str, after: int, limit: int, fields: tuple):
+    """Up to `limit` records after id `after`, projected to `fields`, plus the last id read."""
+    sql, columns = EXPORT_TABLES[table]
+    rows = conn.execute(sql, (after, limit)).fetchall()
+    indices = [columns.index(field) for field in fields]
+    return [{field: row[i] for field, i in zip(fields, indices)} for row in rows], (rows[-1][0] if rows else after)
+
+async def export_records(table: str, fields: tuple, after: int = 0):
+    while True:
+        records, after = await db.run(export_page, table, after, EXPORT_CHUNK_SIZE, fields)
+        if records:
+            yield records
+        if len(records) < EXPORT_CHUNK_SIZE:
+            return
+
+def compressor(encoding: str):
+    """Incremental encoder for a Content-Encoding, None for identity."""
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor().compressobj()
+    if encoding == "gzip":
+        return zlib.compressobj(6, zlib.DEFLATED, 31)
+    return None
+
+def decompressor(encoding: str):
+    if encoding == "zstd":
+        return zstandard.ZstdDecompressor().decompressobj()
+    if encoding == "gzip":
+        return zlib.decompressobj(31)
+    return None
+
+def export_encoding(accept_encoding: str) -> str:
+    accepted = {part.split(";")[0].strip() for part in accept_encoding.lower().split(",")}
+    if "zstd" in accepted and zstandard:
+        return "zstd"
+    if "gzip" in accepted:
+        return "gzip"
+    return "identity"
+
+def import_rows(conn, table: str, records: List[dict]) -> int:
+    """Write one batch of exported records; returns how many were applied.
+
+    Users are matched on username and coins on id. Holdings are set to the
+    imported quantity and the difference is journaled as an 'import' entry.
+    Chats keep their ids, so importing the same file twice is harmless.
+    """
+    cursor = conn.cursor()
+    if table == "users":
+        cursor.executemany('''INSERT INTO users (email, username, password, profilePicture) VALUES (?, ?, ?, ?)
+                              ON CONFLICT (username) DO UPDATE SET email = excluded.email, password = excluded.password,
+                                                                   profilePicture = excluded.profilePicture''',
+                           [(r["email"], r["username"], r.get("password", ""), r.get("profilePicture", "")) for r in records])
+        return len(records)
+    if table == "coins":
+        cursor.executemany('''INSERT INTO coins (id, coinName, coinSymbol, imageUrl) VALUES (?, ?, ?, ?)
+                              ON CONFLICT (id) DO UPDATE SET coinName = excluded.coinName, coinSymbol = excluded.coinSymbol,
+                                                            imageUrl = excluded.imageUrl''',
+                           [(r["id"], r["coinName"], r["coinSymbol"], r.get("imageUrl", "")) for r in records])
+        return len(records)
+    if table == "holdings":
+        cursor.execute("SELECT username, id FROM users WHERE username IN (SELECT value FROM json_each(?))",
+                       (json.dumps(list({r["username"] for r in records})),))
+        user_ids = dict(cursor.fetchall())
+        cursor.execute("SELECT id FROM coins WHERE id IN (SELECT value FROM json_each(?))",
+                       (json.dumps(list({r["coin_id"] for r in records})),))
+        coin_ids = {row[0] for row in cursor.fetchall()}
+        balances = {(user_ids[r["username"]], r["coin_id"]): r["quantity"] for r in records
+                    if r["username"] in user_ids and r["coin_id"] in coin_ids}
+        cursor.execute("SELECT user_id, coin_id, quantity FROM user_coins WHERE user_id IN (SELECT value FROM json_each(?))",
+                       (json.dumps(list(user_ids.values())),))
+        current = {(row[0], row[1]): row[2] for row in cursor.fetchall()}
+        cursor.executemany('''INSERT INTO user_coins (user_id, coin_id, quantity) VALUES (?, ?, ?)
+                              ON CONFLICT (user_id, coin_id) DO UPDATE SET quantity = excluded.quantity''',
+                           [(*key, quantity) for key, quantity in balances.items()])
+        journal(cursor, [(*key, quantity - current.get(key, 0.0), "import", None)
+                         for key, quantity in balances.items() if quantity != current.get(key, 0.0)])
+        return len(balances)
+    cursor.executemany("INSERT OR IGNORE INTO chats (id, from_user, to_user, message, timestamp) VALUES (?, ?, ?, ?, ?)",
+                       [(r.get("id"), r["from_user"], r["to_user"], r["message"], r["timestamp"]) for r in records])
+    return cursor.rowcount
+
+@app.get("/get_users")
+async def get_all_users(fields: str = None, after: int = 0, limit: int = None):
+    """Users as a JSON array, optionally projected to `fields` and paged.
+
+    Without `limit` the whole table is streamed a chunk at a time. With it, one
+    page is returned and X-Next-After carries the cursor for the next one.
+    The default projection still includes password because the app decodes it;
+    a `fields` projection cannot select it.
+    """
+    columns = projected_fields("users", fields, ("email", "username", "password", "profilePicture"))
+    if limit is not None:
+        limit = max(1, min(limit, USERS_PAGE_MAX))
+        records, last = await db.run(export_page, "users", after, limit, columns)
+        return FastJSONResponse(records, headers={"X-Next-After": str(last)} if len(records) == limit else None)
+
+    async def body():
+        prefix = b"["
+        async for records in export_records("users", columns, after):
+            yield prefix + b",".join(dumps(record) for record in records)
+            prefix = b","
+        yield b"[]" if prefix == b"[" else b"]"
+
+    return StreamingResponse(body(), media_type="application/json")
+
+@app.get("/export/{table}")
+async def export_table(table: str, request: Request, fields: str = None, after: int = 0):
+    """Stream a table as NDJSON, compressed per Accept-Encoding (zstd or gzip)."""
+    if table not in EXPORT_TABLES:
+        raise HTTPException(status_code=404, detail="Unknown table")
+    columns = projected_fields(table, fields, tuple(c for c in EXPORT_TABLES[table][1] if c not in PRIVATE_FIELDS))
+    encoding = export_encoding(request.headers.get("accept-encoding", ""))
+
+    async def body():
+        encoder = compressor(encoding)
+        async for records in export_records(table, columns, after):
+            chunk = b"".join(dumps(record) + b"\n" for record in records)
+            chunk = encoder.compress(chunk) if encoder else chunk
+            if chunk:
+                yield chunk
+        if encoder:
+            yield encoder.flush()
+
+    headers = {"Content-Encoding": encoding} if encoding != "identity" else None
+    return StreamingResponse(body(), media_type="application/x-ndjson", headers=headers)
+
+COINS_PAGE_SIZE = 25
+
+LEDGER_PAGE_SIZE = 100
+
+def ledger_balances(conn, user_ids: List[int], as_of: float):
+    """Balances per (user_id, coin_id) replayed from the journal up to `as_of`."""
+    return conn.execute('''SELECT user_id, coin_id, SUM(delta) FROM ledger
+                            WHERE user_id IN (SELECT value FROM json_each(?)) AND timestamp <= ?
+                            GROUP BY user_id, coin_id''', (json.dumps(user_ids), as_of)).fetchall()
+
+def user_id_for(cursor, username: str) -> int:
+    cursor.execute("SELECT id FROM users WHERE username = ?", (username,))
+    user = cursor.fetchone()
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    return user[0]
+
+@app.get("/ledger/{username}")
+async def get_ledger(username: str, after: int = 0, limit: int = LEDGER_PAGE_SIZE):
+    """Journal entries for a user in the order they were written."""
+    limit = max(1, min(limit, 1000))
+
+    def query(conn):
+        cursor = conn.cursor()
+        cursor.execute('''SELECT id, coin_id, delta, kind, transfer_id, timestamp FROM ledger
+                          WHERE user_id = ? AND id > ? ORDER BY id LIMIT ?''', (user_id_for(cursor, username), after, limit))
+        return cursor.fetchall()
+
+    rows = await db.run(query)
+    return {
+        "entries": [{"id": row[0], "coin_id": row[1], "delta": row[2], "kind": row[3], "transfer_id": row[4], "timestamp": row[5]}
+                    for row in rows],
+        "next": rows[-1][0] if len(rows) == limit else None
+    }
+
+@app.get("/ledger/{username}/balances")
+async def get_ledger_balances(username: str, as_of: float = None):
+    """Balances rebuilt from the journal as of a unix timestamp (default: now)."""
+    as_of = time.time() if as_of is None else as_of
+
+    def query(conn):
+        return ledger_balances(conn, [user_id_for(conn.cursor(), username)], as_of)
+
+    rows = await db.run(query)
+    return {"as_of": as_of, "balances": [{"coin_id": row[1], "quantity": row[2]} for row in rows]}
+
 @app.get("/get_coins/{page}/{search}")
-async def get_coins_page(page: int, search: str = None):
-    with sqlite3.connect("chat.db") as conn:
+async def get_coins_page(page: int, search: str = None, after: str = None):
+    """A page of coins, optionally filtered by a symbol/name substring.
+
+    Pages are addressed by number, or by the `next` cursor from the previous
+    response, which seeks directly past the last row instead of using OFFSET.
+    Searches are answered from the catalog's in-memory index.
+    """
+    limit = COINS_PAGE_SIZE
+    offset = (page - 1) * limit
+
+    if search != "@All":
+        keys, ids = catalog.search.ranked(search.lower())
+        if after:
+            rank, _, name = after.partition(":")
+            start = bisect.bisect_right(keys, (int(rank) if rank.isdigit() else 0, name))
+        else:
+            start = max(0, offset)
+        by_id = catalog.by_id
+        coin = [by_id[coin_id] for coin_id in ids[start:start + limit]]
+        last = start + limit - 1
+        total_pages = math.ceil(len(ids) / limit)
+        log.debug("₿ Fetched page %s of %s total pages for search : '%s' of coins", page, total_pages, search)
+        return FastJSONResponse({
+            "coin": coin,
+            "total_pages": total_pages,
+            "next": f"{keys[last][0]}:{keys[last][1]}" if last < len(keys) else None
+        })
+
+    def query(conn):
         cursor = conn.cursor()
-        limit = 25
-        offset = (page - 1) * limit
-        
-        if search != "@All":
-            search_term = f"%{search.lower()}%"
-            # Get total count
-            cursor.execute("""
-                SELECT COUNT(*) 
-                FROM coins 
-                WHERE LOWER(coinSymbol) LIKE ? OR LOWER(coinName) LIKE ?
-            """, (search_term, search_term))
-            total_count = cursor.fetchone()[0]
-            
-            # Get paginated results
-            cursor.execute("""
-                SELECT id, coinSymbol, coinName, imageUrl 
-                FROM coins 
-                WHERE LOWER(coinSymbol) LIKE ? OR LOWER(coinName) LIKE ?
-                ORDER BY 
-                    CASE 
-                        WHEN LOWER(coinName) LIKE ? THEN 1
-                        WHEN LOWER(coinName) LIKE ? THEN 2
-                        ELSE 3
-                    END,
-                    coinName
-                LIMIT ? OFFSET ?
-            """, (search_term, search_term, f"{search_term[1:]}%", f"%{search_term[1:]}%", limit, offset))
+
+        # Get total count
+        cursor.execute("SELECT COUNT(*) FROM coins")
+        total_count = cursor.fetchone()[0]
+
+        # Get paginated results
+        if after:
+            cursor.execute("SELECT id FROM coins WHERE id > ? ORDER BY id LIMIT ?",
+                           (int(after) if after.isdigit() else 0, limit))
         else:
-            # Get total count
-            cursor.execute("SELECT COUNT(*) FROM coins")
-            total_count = cursor.fetchone()[0]
-            
-            # Get paginated results
             cursor.execute("""
-                SELECT id, coinSymbol, coinName, imageUrl 
+                SELECT id
                 FROM coins 
                 ORDER BY id
                 LIMIT ? OFFSET ?
             """, (limit, offset))
-            
-        coin = [{"id": int(row[0]), "coinSymbol": row[1].upper() + "USDT", "coinName": row[2], "imageUrl": row[3]} 
-                for row in cursor.fetchall()]
-        
-        total_pages = math.ceil(total_count / limit)  # Calculate total pages using ceiling function
-        print(f"₿ Fetched page {page} of {total_pages} total pages for search : '{search}' of coins")
-        return {
-            "coin": coin,
-            "total_pages": total_pages
-        }
+
+        rows = cursor.fetchall()
+        next_cursor = str(rows[-1][0]) if len(rows) == limit else None
+        return [row[0] for row in rows], total_count, next_cursor
+
+    coin_ids, total_count, next_cursor = await db.run(query)
+    if any(coin_id not in catalog.by_id for coin_id in coin_ids):
+        await catalog.invalidate()
+    # Display symbols are precomputed in the catalog
+    by_id = catalog.by_id
+    coin = [by_id[coin_id] for coin_id in coin_ids if coin_id in by_id]
+    total_pages = math.ceil(total_count / limit)  # Calculate total pages using ceiling function
+    log.debug("₿ Fetched page %s of %s total pages for search : '%s' of coins", page, total_pages, search)
+    return FastJSONResponse({
+        "coin": coin,
+        "total_pages": total_pages,
+        "next": next_cursor
+    })
 
         
-@app.get("/coins/{coin_symbol}", response_model=CoinDetails)
-async def get_coin(coin_symbol: str):
-    with sqlite3.connect("chat.db") as conn:
-        coin_symbol = coin_symbol.lower().replace("usdt", "")
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, coinSymbol, coinName, imageUrl FROM coins WHERE LOWER(coinSymbol) = LOWER(?)", (coin_symbol,))
-        row = cursor.fetchone()
+def catalog_response(coin: dict, request: Request, response: Response):
+    if not coin:
+        raise HTTPException(status_code=404, detail="Coin not found")
+    headers = catalog.cache_headers()
+    if request.headers.get("if-none-match") == catalog.etag:
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return coin
 
-        if row:
-            return {"id": row[0], "coinSymbol": row[1].upper() + "USDT", "coinName": row[2], "imageUrl": row[3]}
-        else:
-            raise HTTPException(status_code=404, detail="Coin not found")
+@app.get("/coins/{coin_symbol}", response_model=CoinDetails)
+async def get_coin(coin_symbol: str, request: Request, response: Response):
+    return catalog_response(catalog.by_symbol.get(normalize_symbol(coin_symbol)), request, response)
         
 
 @app.get("/name_coin/{coinSymbol}", response_model=CoinDetails)
-async def get_coin_by_name(coinSymbol: str):
-    with sqlite3.connect("chat.db") as conn:
-        cursor = conn.cursor()
-        coinSymbol = coinSymbol.lower().replace("usdt", "")
-        cursor.execute("SELECT id, coinSymbol, coinName, imageUrl FROM coins WHERE LOWER(coinName) = LOWER(?)", (coinSymbol,))
-        row = cursor.fetchone()
-        
-        if row:
-            return {"id": row[0], "coinSymbol": row[1].upper() + "USDT", "coinName": row[2], "imageUrl": row[3]}
-        else:
-            raise HTTPException(status_code=404, detail="Coin not found")
+async def get_coin_by_name(coinSymbol: str, request: Request, response: Response):
+    return catalog_response(catalog.by_name.get(normalize_symbol(coinSymbol)), request, response)
+
+CHAT_PAGE_SIZE = 50
+CHAT_PAGE_MAX = 500
+
+def parse_chat_cursor(cursor: str):
+    """Decode a "<timestamp>:<id>" keyset cursor."""
+    try:
+        timestamp, message_id = cursor.split(":")
+        return int(timestamp), int(message_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor, expected <timestamp>:<id>")
 
 @app.get("/get_chat_history/{from_user}")
 async def get_chat_history(from_user: str):
-    with sqlite3.connect("chat.db") as conn:
+    def query(conn):
         cursor = conn.cursor()
-        # Get all unique users that from_user has chatted with
+        # Both directions come straight off the (from_user, to_user) / (to_user, from_user) indexes
         cursor.execute('''
-            SELECT DISTINCT CASE 
-                WHEN from_user = ? THEN to_user 
-                ELSE from_user 
-            END as other_user
-            FROM chats 
-            WHERE from_user = ? OR to_user = ?
-        ''', (from_user, from_user, from_user))
-        
-        users = [row[0] for row in cursor.fetchall()]
+            SELECT from_user, to_user, message, timestamp FROM (
+                SELECT id, from_user, to_user, message, timestamp FROM chats WHERE from_user = ?
+                UNION ALL
+                SELECT id, from_user, to_user, message, timestamp FROM chats WHERE to_user = ? AND from_user != ?
+            )
+            ORDER BY CASE WHEN from_user = ? THEN to_user ELSE from_user END, timestamp, id
+        ''', (from_user, from_user, from_user, from_user))
         
-        # Get chat history for each user
-        chat_history = []
-        for user in users:
-            cursor.execute('''
-                SELECT from_user, to_user, message, timestamp
-                FROM chats 
-                WHERE (from_user = ? AND to_user = ?) OR (to_user = ? AND from_user = ?)
-                ORDER BY timestamp
-            ''', (from_user, user, from_user, user))
-            
-            rows = cursor.fetchall()
-            chat_history.extend([{"from": row[0], "to": row[1], "message": row[2], "timestamp": row[3]} 
-                               for row in rows])
-        
-        return chat_history
+        return [{"from": row[0], "to": row[1], "message": row[2], "timestamp": row[3]} 
+                for row in cursor.fetchall()]
 
-active_connections: Dict[str, WebSocket] = {}
+    return FastJSONResponse(await db.run(query))
 
-@app.websocket("/ws/{username}")
-async def websocket_endpoint(websocket: WebSocket, username: str):
-    print(f"🔗 New WebSocket connection: {username}")
+@app.get("/get_chat_history/{from_user}/{to_user}")
+async def get_conversation(from_user: str, to_user: str, before: str = None, after: str = None,
+                           limit: int = CHAT_PAGE_SIZE):
+    """One page of a conversation, oldest first.
 
-    await websocket.accept()
-    active_connections[username] = websocket  # Store user connection
+    Without a cursor the newest `limit` messages are returned. Pass `before`
+    (next_before) to page back in time or `after` (next_after) to fetch newer ones.
+    """
+    if before and after:
+        raise HTTPException(status_code=400, detail="Use either before or after, not both")
+    limit = max(1, min(limit, CHAT_PAGE_MAX))
+    forward = after is not None
+    bound = parse_chat_cursor(after if forward else before) if (after or before) else None
 
+    def query(conn):
+        keyset = ""
+        if bound:
+            keyset = "AND (timestamp, id) > (?, ?)" if forward else "AND (timestamp, id) < (?, ?)"
+        order = "timestamp, id" if forward else "timestamp DESC, id DESC"
+        side = ("SELECT id, from_user, to_user, message, timestamp FROM chats "
+                "WHERE from_user = ? AND to_user = ? {} " + keyset + " ORDER BY " + order + " LIMIT ?")
+        bound_args = bound or ()
+        cursor = conn.cursor()
+        # Each direction is a bounded index range scan; merging them keeps the newest/oldest `limit`
+        cursor.execute(f'''
+            SELECT * FROM ({side.format("")})
+            UNION ALL
+            SELECT * FROM ({side.format("AND from_user != to_user")})
+            ORDER BY {order} LIMIT ?
+        ''', (from_user, to_user, *bound_args, limit, to_user, from_user, *bound_args, limit, limit))
+        return cursor.fetchall()
+
+    rows = await db.run(query)
+    if not forward:
+        rows.reverse()
+    return FastJSONResponse({
+        "messages": [{"from": row[1], "to": row[2], "message": row[3], "timestamp": row[4]} for row in rows],
+        "next_before": f"{rows[0][4]}:{rows[0][0]}" if rows else before,
+        "next_after": f"{rows[-1][4]}:{rows[-1][0]}" if rows else after,
+    })
+
+@app.get("/get_conversations/{username}")
+async def get_conversations(username: str):
+    """Last message exchanged with every chat partner, most recent first."""
+    def query(conn):
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT partner, from_user, to_user, message, timestamp FROM (
+                SELECT CASE WHEN from_user = ? THEN to_user ELSE from_user END AS partner,
+                       from_user, to_user, message, timestamp, id,
+                       ROW_NUMBER() OVER (PARTITION BY CASE WHEN from_user = ? THEN to_user ELSE from_user END
+                                          ORDER BY timestamp DESC, id DESC) AS position
+                FROM (
+                    SELECT id, from_user, to_user, message, timestamp FROM chats WHERE from_user = ?
+                    UNION ALL
+                    SELECT id, from_user, to_user, message, timestamp FROM chats WHERE to_user = ? AND from_user != ?
+                )
+            )
+            WHERE position = 1
+            ORDER BY timestamp DESC, id DESC
+        ''', (username, username, username, username, username))
+        return [{"user": row[0], "last_message": {"from": row[1], "to": row[2], "message": row[3], "timestamp": row[4]}}
+                for row in cursor.fetchall()]
+
+    return await db.run(query)
+
+@app.get("/portfolio/{username}")
+async def get_portfolio(username: str):
+    """Per-coin and total value of a user's holdings at the latest prices."""
+    result = (await portfolio.value([username]))[username]
+    if result is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return result
+
+@app.post("/portfolio/batch")
+async def get_portfolios(batch: PortfolioBatch):
+    results = await portfolio.value(list(dict.fromkeys(batch.usernames)))
+    return {
+        "portfolios": [result if batch.details else {"username": result["username"], "total": result["total"]}
+                       for result in results.values() if result is not None],
+        "missing": [username for username, result in results.items() if result is None],
+    }
+
+@app.get("/prices")
+async def get_prices(symbols: str = None):
+    """Latest known prices, optionally limited to a comma-separated list of symbols."""
+    if symbols is None:
+        return list(price_hub.latest.values())
+    return [price_hub.latest[symbol] for symbol in symbols.upper().split(",") if symbol in price_hub.latest]
+
+@app.get("/history/{symbol}")
+async def get_history(symbol: str, interval: str = "1m", start: int = Query(None, alias="from"),
+                      end: int = Query(None, alias="to"), points: int = HISTORY_POINTS):
+    """OHLC candles for [from, to) in ms, oldest first.
+
+    `interval` is the smallest bucket wanted; wider ranges are merged
+    server-side into at most `points` candles. Defaults to the last `points`
+    buckets. "BTC" is read as "BTCUSDT" when only the latter is known.
+    """
+    symbol = symbol.upper()
+    if not symbol.isalnum():
+        raise HTTPException(status_code=400, detail="Invalid symbol")
+    symbol = await candles.resolve(symbol)
+    width = parse_interval(interval)
+    points = max(1, min(points, HISTORY_POINTS))
+    end = int(time.time() * 1000) if end is None else end
+    start = end - width * points if start is None else start
+    if start >= end:
+        raise HTTPException(status_code=400, detail="from must be before to")
+    bucket, rows = await candles.history(symbol, width, start, end, points)
+    return FastJSONResponse({"symbol": symbol, "interval": bucket, "candles": rows})
+
+# Declared before /ws/{username} so that route does not capture it
+@app.websocket("/ws/prices")
+async def price_stream(websocket: WebSocket):
+    """Push price updates for subscribed symbols.
+
+    Clients send {"subscribe": [...]} / {"unsubscribe": [...]} with symbols
+    such as "BTCUSDT" or "*", and receive {"prices": [...]} batches holding
+    only the newest tick per symbol since their previous batch. Malformed
+    requests are answered with {"error": ...} and otherwise ignored.
+    """
+    await websocket.accept()
+    subscriber = PriceSubscriber()
+    writer = asyncio.create_task(subscriber.drain(websocket))
     try:
-        with sqlite3.connect("chat.db") as conn:
-            while True:
+        while True:
+            try:
                 data = await websocket.receive_json()
-                recipient, message = data.get("to"), data.get("message")
-                timestamp = int(time.time())
+            except (ValueError, TypeError, KeyError):  # not a JSON text frame
+                subscriber.error("Invalid JSON")
+                continue
+            if not isinstance(data, dict):
+                subscriber.error("Expected an object")
+                continue
+            for action, apply in (("subscribe", price_hub.subscribe), ("unsubscribe", price_hub.unsubscribe)):
+                symbols = data.get(action)
+                if not symbols:
+                    continue
+                if not isinstance(symbols, list) or not all(isinstance(symbol, str) for symbol in symbols):
+                    subscriber.error(f"{action} takes a list of symbols")
+                    continue
+                apply(subscriber, symbols)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        price_hub.unsubscribe(subscriber)
+        writer.cancel()
+        await asyncio.gather(writer, return_exceptions=True)
 
-                if message.startswith("@payment"):
-                    try:
-                        _, coinId, amount, address = message.split(",")
+def encode(payload: dict) -> str:
+    return dumps(payload).decode()
 
-                        # Verify Address
-                        try:
-                            receiver_username, coin_id = address.split("_")
-                        except ValueError:
-                            await websocket.send_json({"error": "Invalid payment address format"})
-                            continue
-
-                        cursor = conn.cursor()
-                        print(message, receiver_username, coin_id)
-                        print(receiver_username,coin_id)
-                        cursor.execute("SELECT id FROM users WHERE username = ?", (receiver_username,))
-                        user_row = cursor.fetchone()
-                        print()
-                        if not user_row or coinId != coin_id:
-                            await websocket.send_json({"error": "Invalid payment address"})
-                            continue
-
-                        # Check user's balance for the specified coin
-                        cursor.execute('''
-                            SELECT quantity
-                            FROM user_coins 
-                            WHERE user_id = (SELECT id FROM users WHERE username = ?) AND coin_id = ?
-                        ''', (username ,coinId))
-                        balance_row = cursor.fetchone()
-                        if not balance_row or not balance_row[0] or float(balance_row[0]) < float(amount):
-                            print(2)
-                            await websocket.send_json({"error": f"Insufficient balance. Available {balance_row[0]}"})
-                            continue
-
-                        # Update user's balance by deducting the payment amount
-                        cursor.execute('''
-                            UPDATE user_coins 
-                            SET quantity = quantity - ?
-                            WHERE user_id = (SELECT id FROM users WHERE username = ?) AND coin_id = ?
-                        ''', (float(amount), username, coinId))
-                        conn.commit()
-
-                        # Update recipient's balance by adding the payment amount
-                        cursor.execute('''
-                            UPDATE user_coins 
-                            SET quantity = quantity + ?
-                            WHERE user_id = (SELECT id FROM users WHERE username = ?) AND coin_id = ?
-                        ''', (float(amount), receiver_username, coinId))
-                        conn.commit()
-
-                        cursor.execute("SELECT coinSymbol, coinName, imageUrl FROM coins WHERE id = ?", (coinId,))
-                        coinSymbol, coinName, coinImage  = cursor.fetchone()
-                        message = f"@payment,{coinImage},{coinName},{coinSymbol},{amount}"
-
-                    except Exception as e:
-                        print(f"⚠️ Payment processing error: {e}")
-                        await websocket.send_json({"error": {e}})
-                        continue
+class ClientConnection:
+    """A chat socket with a bounded outbound queue drained by its own writer task.
+
+    `send` never waits on the network, so a slow or stalled recipient only
+    backs up its own queue. When the queue is full the socket is closed
+    ("disconnect"), or ("drop_oldest") the oldest echo, pong or error frame is
+    dropped to make room. Deliveries, the frames carrying a `seq`, are never
+    dropped: acks are cumulative, so a later ack would lose them for good. If
+    only deliveries are queued, an incoming delivery closes the socket instead
+    and the client gets everything back from pending_deliveries on a `since=`
+    resume. Frames are pre-encoded text, so one encoding serves every send of it.
+
+    Live deliveries can arrive out of seq order (each sender routes its own,
+    some through other workers), so the connection remembers which ones it
+    queued: an ack only trims the replayed range and those, never a seq that
+    is still on its way.
+    """
+
+    def __init__(self, websocket: WebSocket, username: str, max_queue: int, overflow: str, idle_timeout: float):
+        self.websocket = websocket
+        self.username = username
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.idle_timeout = idle_timeout
+        self.frames = collections.deque()
+        self.ready = asyncio.Event()
+        self.last_seen = time.monotonic()
+        self.closed = False
+        self.synced = 0
+        self.unacked = set()
+        self._writer: asyncio.Task = None
+
+    def start(self, synced: int = 0):
+        """Start sending; deliveries up to `synced` already went out in a `since=` replay and are skipped."""
+        self.synced = synced
+        self.frames = collections.deque((text, seq) for text, seq in self.frames if seq is None or seq > synced)
+        self.unacked = {seq for _, seq in self.frames if seq is not None}
+        self._writer = asyncio.create_task(self._drain())
 
+    def send(self, text: str, seq: int = None) -> bool:
+        """Queue a frame, `seq` given for deliveries; False when it was dropped or the socket is closed."""
+        if self.closed:
+            return False
+        if seq is not None and seq <= self.synced:
+            return True  # committed before the replay read it, so it was sent from there
+        if len(self.frames) >= self.max_queue:
+            if self.overflow == "disconnect":
+                self.abort("overflow", 1013)
+                return False
+            victim = next((i for i, (_, queued_seq) in enumerate(self.frames) if queued_seq is None), None)
+            if victim is not None:
+                del self.frames[victim]
+            elif seq is None:
+                ws_dropped_frames.inc()
+                return False
+            else:
+                self.abort("overflow", 1013)
+                return False
+            ws_dropped_frames.inc()
+        self.frames.append((text, seq))
+        if seq is not None:
+            self.unacked.add(seq)
+        self.ready.set()
+        return True
+
+    def acked(self, seq: int):
+        """Split an {"ack": seq} into the replayed range it covers and the live deliveries queued here up to it."""
+        seqs = sorted(queued for queued in self.unacked if queued <= seq)
+        self.unacked.difference_update(seqs)
+        return min(seq, self.synced), seqs
+
+    def send_json(self, payload: dict) -> bool:
+        return self.send(encode(payload))
+
+    def touch(self):
+        self.last_seen = time.monotonic()
+
+    async def _drain(self):
+        try:
+            while True:
                 try:
-                    conn.execute(
-                        "INSERT INTO chats (from_user, to_user, message, timestamp) VALUES (?, ?, ?, ?)",
-                        (username, recipient, message, timestamp),
-                    )
-                    conn.commit()
-                except sqlite3.Error as e:
-                    print(f"⚠️ Database error: {e}")
-                    await websocket.send_json({"error": "Failed to save message"})
+                    await asyncio.wait_for(self.ready.wait(), HEARTBEAT_INTERVAL)
+                except asyncio.TimeoutError:
+                    if self.idle_timeout and time.monotonic() - self.last_seen > self.idle_timeout:
+                        self.abort("idle", 1001)
+                        return
                     continue
-                
-                print(f"📩 {username} → {recipient}: {message} | 🕒 {timestamp}")
+                self.ready.clear()
+                while self.frames:
+                    text, _ = self.frames.popleft()
+                    if text is None:
+                        return
+                    await asyncio.wait_for(self.websocket.send_text(text), SEND_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.abort("stalled", 1013)
+        except Exception as e:
+            if not self.closed:
+                ws_send_failures.inc("writer")
+                log.warning("⚠️ Send error to %s: %s", self.username, e)
+                self.abort("failed", 1011)
+
+    def abort(self, reason: str, code: int):
+        """Close a socket that cannot keep up or has gone quiet; its handler then cleans up."""
+        if self.closed:
+            return
+        self.closed = True
+        self.frames.clear()
+        ws_reaped.inc(reason)
+        log.info("✂️ Closing %s: %s", self.username, reason)
+        if self._writer is not None and self._writer is not asyncio.current_task():
+            self._writer.cancel()
+        asyncio.create_task(self._close(code))
+
+    async def _close(self, code: int):
+        try:
+            await asyncio.wait_for(self.websocket.close(code), SEND_TIMEOUT)
+        except Exception:
+            pass
+
+    async def stop(self):
+        """Flush what is already queued, bounded by SEND_TIMEOUT, and end the writer."""
+        if self._writer is None:
+            return
+        if not self.closed:
+            self.closed = True
+            self.frames.append((None, None))
+            self.ready.set()
+        await asyncio.wait({self._writer}, timeout=SEND_TIMEOUT)
+        self._writer.cancel()
+
+active_connections: Dict[str, ClientConnection] = {}
+NODE_CHANNEL = "cryptosphere:node:"  # followed by a node id: the channel that worker subscribes to
+
+class LocalBackplane:
+    """In-process backplane. Routers sharing one `bus` behave like workers on one broker."""
+
+    def __init__(self, bus: dict = None):
+        self.bus = bus if bus is not None else {"channels": {}, "presence": {}}
+        self._channel = None
+
+    async def start(self, channel: str, handler):
+        self._channel = channel
+        self.bus["channels"][channel] = handler
+
+    async def stop(self):
+        self.bus["channels"].pop(self._channel, None)
+
+    async def publish(self, channel: str, message: str) -> int:
+        """Hand `message` to the channel's subscriber; the number of receivers, as PUBLISH returns."""
+        handler = self.bus["channels"].get(channel)
+        if handler is None:
+            return 0
+        await handler(message)
+        return 1
+
+    async def set_presence(self, username: str, node: str):
+        self.bus["presence"][username] = node
+
+    async def refresh_presence(self, usernames: List[str], node: str):
+        pass  # entries live as long as the process, so there is nothing to expire
+
+    async def clear_presence(self, username: str, node: str):
+        if self.bus["presence"].get(username) == node:
+            del self.bus["presence"][username]
+
+    async def locate(self, username: str):
+        return self.bus["presence"].get(username)
+
+    async def route(self, username: str, message: str, sender: str) -> int:
+        """Publish `message` to the node `username` is connected to unless that is `sender`; the number of receivers."""
+        node = self.bus["presence"].get(username)
+        if node is None or node == sender:
+            return 0
+        return await self.publish(NODE_CHANNEL + node, message)
+
+class RespError(Exception):
+    """An error reply from the server."""
+
+class RespConnection:
+    """Minimal client for the Redis serialization protocol (RESP2).
+
+    Commands are pipelined: any number can be in flight at once, and a reader
+    task hands each reply to the oldest command still waiting, the order the
+    server answers in. A caller that is cancelled leaves its place in line, so
+    its reply is still consumed in turn and never read as a later command's.
+    """
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.reader: asyncio.StreamReader = None
+        self.writer: asyncio.StreamWriter = None
+        self._lock = asyncio.Lock()
+        self._pending = collections.deque()
+        self._receiver: asyncio.Task = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+    def close(self, error: Exception = None):
+        """Close the connection; commands still waiting for replies fail with `error`."""
+        if self._receiver is not None:
+            self._receiver.cancel()
+            self._receiver = None
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        while self._pending:
+            future = self._pending.popleft()
+            if not future.done():
+                future.set_exception(error or ConnectionError("Backplane connection closed"))
+
+    def send(self, *args):
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        self.writer.write(b"".join(parts))
+
+    async def read(self):
+        line = await self.reader.readline()
+        if not line:
+            raise ConnectionError("Backplane connection closed")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode()
+        if kind == b"-":
+            return RespError(rest.decode())
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            length = int(rest)
+            return None if length < 0 else (await self.reader.readexactly(length + 2))[:-2]
+        if kind == b"*":
+            length = int(rest)
+            return None if length < 0 else [await self.read() for _ in range(length)]
+        raise RuntimeError(f"Unexpected RESP reply {line!r}")
+
+    async def _receive(self):
+        try:
+            while True:
+                reply = await self.read()
+                future = self._pending.popleft()
+                if not future.done():  # its caller was cancelled
+                    future.set_result(reply)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._receiver = None
+            self.close(e if isinstance(e, ConnectionError) else ConnectionError(f"Backplane connection lost: {e}"))
+
+    async def open(self):
+        """Connect for commands, unless already connected."""
+        async with self._lock:
+            if self.writer is None:
+                await self.connect()
+                self._receiver = asyncio.create_task(self._receive())
+
+    async def pipeline(self, commands: list) -> list:
+        """Send `commands` in one write and return their replies in order, error replies as RespError."""
+        if self.writer is None:
+            await self.open()
+        loop = asyncio.get_running_loop()
+        futures = [loop.create_future() for _ in commands]
+        for args in commands:
+            self.send(*args)
+        self._pending.extend(futures)
+        await self.writer.drain()
+        return list(await asyncio.gather(*futures))
+
+    async def command(self, *args):
+        reply = (await self.pipeline([args]))[0]
+        if isinstance(reply, RespError):
+            raise reply
+        return reply
+
+class RedisBackplane:
+    """Backplane over any Redis-protocol server: PUBLISH/SUBSCRIBE for delivery, expiring keys for presence.
+
+    Each connected user has a "cryptosphere:presence:<username>" key naming
+    their node, set with a PRESENCE_TTL its worker keeps refreshing, so users
+    of a crashed worker drop offline once their keys expire. Refreshing and
+    clearing only touch keys that still name this node, atomically in a script.
+    Routing looks the recipient up and publishes in one script as well, so a
+    delivery to another worker costs a single round trip.
+    """
+
+    PRESENCE_KEY = "cryptosphere:presence:"
+    REFRESH_SCRIPT = ('local node = redis.call("GET", KEYS[1]) '
+                      'if node == false or node == ARGV[1] then return redis.call("SET", KEYS[1], ARGV[1], "EX", ARGV[2]) end '
+                      'return false')
+    CLEAR_SCRIPT = 'if redis.call("GET", KEYS[1]) == ARGV[1] then return redis.call("DEL", KEYS[1]) end return 0'
+    ROUTE_SCRIPT = ('local node = redis.call("GET", KEYS[1]) '
+                    'if node == false or node == ARGV[1] then return 0 end '
+                    'return redis.call("PUBLISH", ARGV[2] .. node, ARGV[3])')
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self._commands = RespConnection(host, port)
+        self._task: asyncio.Task = None
+
+    async def start(self, channel: str, handler):
+        await self._commands.open()
+        self._task = asyncio.create_task(self._listen(channel, handler))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        self._commands.close()
+
+    async def _listen(self, channel: str, handler):
+        while True:
+            subscriber = RespConnection(self.host, self.port)
+            try:
+                await subscriber.connect()
+                subscriber.send("SUBSCRIBE", channel)
+                await subscriber.writer.drain()
+                while True:
+                    reply = await subscriber.read()
+                    if isinstance(reply, list) and reply[0] == b"message":
+                        try:
+                            await handler(reply[2].decode())
+                        except Exception as e:
+                            ws_send_failures.inc("backplane")
+                            log.warning("⚠️ Backplane delivery error: %s", e)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.error("⚠️ Backplane subscription lost: %s", e)
+                await asyncio.sleep(1)
+            finally:
+                subscriber.close()
+
+    async def publish(self, channel: str, message: str) -> int:
+        return await self._commands.command("PUBLISH", channel, message)
+
+    async def set_presence(self, username: str, node: str):
+        await self._commands.command("SET", self.PRESENCE_KEY + username, node, "EX", PRESENCE_TTL)
+
+    async def refresh_presence(self, usernames: List[str], node: str):
+        if usernames:
+            await self._commands.pipeline([("EVAL", self.REFRESH_SCRIPT, 1, self.PRESENCE_KEY + username, node, PRESENCE_TTL)
+                                           for username in usernames])
+
+    async def clear_presence(self, username: str, node: str):
+        # Another node may have taken the user over since; only clear our own entry
+        await self._commands.command("EVAL", self.CLEAR_SCRIPT, 1, self.PRESENCE_KEY + username, node)
+
+    async def locate(self, username: str):
+        node = await self._commands.command("GET", self.PRESENCE_KEY + username)
+        return node.decode() if node is not None else None
+
+    async def route(self, username: str, message: str, sender: str) -> int:
+        return await self._commands.command("EVAL", self.ROUTE_SCRIPT, 1, self.PRESENCE_KEY + username, sender, NODE_CHANNEL, message)
+
+def make_backplane(url: str):
+    if url == "local":
+        return LocalBackplane()
+    if url.startswith("redis://"):
+        host, _, port = url[len("redis://"):].rstrip("/").partition(":")
+        return RedisBackplane(host, int(port or 6379))
+    raise ValueError(f"Unknown backplane {url!r}")
+
+class ChatRouter:
+    """Delivers chat payloads to users connected to this worker or, via the backplane, to another one.
+
+    Each worker subscribes to its own node channel and records which node
+    each of its users is connected to in the presence registry, refreshing
+    those entries every PRESENCE_REFRESH seconds while they stay. Frames are
+    encoded once by the sender's worker; backplane messages carry them as
+    "<recipient>\n<seq>\n<frame>" so the receiving worker forwards them untouched.
+    """
+
+    def __init__(self, backplane, connections: Dict[str, ClientConnection]):
+        self.backplane = backplane
+        self.connections = connections
+        self.node = uuid.uuid4().hex
+        self.channel = NODE_CHANNEL + self.node
+        self._task: asyncio.Task = None
+
+    async def start(self):
+        await self.backplane.start(self.channel, self._deliver_local)
+        self._task = asyncio.create_task(self._keep_presence())
 
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        await self.backplane.stop()
+
+    async def _keep_presence(self):
+        while True:
+            await asyncio.sleep(PRESENCE_REFRESH)
+            try:
+                await self.backplane.refresh_presence(list(self.connections), self.node)
+            except Exception as e:
+                log.warning("⚠️ Presence refresh failed: %s", e)
+
+    async def connected(self, username: str):
+        await self.backplane.set_presence(username, self.node)
+
+    async def disconnected(self, username: str):
+        await self.backplane.clear_presence(username, self.node)
+
+    def _send_local(self, recipient: str, frame: str, seq: int) -> bool:
+        client = self.connections.get(recipient)
+        return client is not None and client.send(frame, seq)
+
+    async def _deliver_local(self, message: str) -> bool:
+        recipient, seq, frame = message.split("\n", 2)
+        return self._send_local(recipient, frame, int(seq))
+
+    async def deliver(self, recipient: str, frame: str, seq: int) -> bool:
+        """Queue the encoded delivery `seq` for `recipient`; False when they are not connected anywhere."""
+        if recipient in self.connections:
+            return self._send_local(recipient, frame, seq)
+        # No subscriber means the node died without clearing its presence entries
+        return await self.backplane.route(recipient, f"{recipient}\n{seq}\n{frame}", self.node) > 0
+
+router = ChatRouter(make_backplane(BACKPLANE_URL), active_connections)
+
+class PaymentError(Exception):
+    """Raised when an @payment message cannot be applied; the text is sent back to the sender."""
+
+class PaymentEngine:
+    """Applies @payment transfers, each as one atomic transaction.
+
+    Transfers hold an asyncio lock per account involved, taken in name order,
+    so transfers touching the same account queue up here instead of contending
+    for the write lock while unrelated accounts proceed. A transfer carrying an
+    idempotency key is recorded once; retrying it returns the original result.
+    """
+
+    def __init__(self, db: Database, catalog: CoinCatalog):
+        self.db = db
+        self.catalog = catalog
+        self._locks = weakref.WeakValueDictionary()
+
+    def _lock(self, username: str) -> asyncio.Lock:
+        lock = self._locks.get(username)
+        if lock is None:
+            lock = self._locks[username] = asyncio.Lock()
+        return lock
+
+    @staticmethod
+    def parse(message: str):
+        """Split "@payment,<coin id>,<amount>,<receiver>_<coin id>" into its parts."""
+        try:
+            _, coin_id, amount, address = message.split(",")
+        except ValueError:
+            raise PaymentError("Invalid payment format")
+
+        # Verify Address
+        receiver_username, _, address_coin_id = address.rpartition("_")
+        if not receiver_username:
+            raise PaymentError("Invalid payment address format")
+        if address_coin_id != coin_id:
+            raise PaymentError("Invalid payment address")
+        try:
+            quantity = float(amount)
+            coin_id = int(coin_id)
+        except ValueError:
+            raise PaymentError("Invalid payment amount")
+        if not quantity > 0:
+            raise PaymentError("Amount must be positive")
+        return receiver_username, coin_id, amount, quantity
+
+    @staticmethod
+    def _transfer(conn, sender: str, receiver: str, coin_id: int, quantity: float, key: str):
+        cursor = conn.cursor()
+        cursor.execute("SELECT username, id FROM users WHERE username IN (?, ?)", (sender, receiver))
+        user_ids = dict(cursor.fetchall())
+        if receiver not in user_ids:
+            raise PaymentError("Invalid payment address")
+        if sender not in user_ids:
+            raise PaymentError("User not found")
+
+        if key is not None:
+            cursor.execute("SELECT from_user_id, to_user_id, coin_id, amount FROM transfers WHERE idempotency_key = ?", (key,))
+            previous = cursor.fetchone()
+            if previous is not None:
+                if previous != (user_ids[sender], user_ids[receiver], coin_id, quantity):
+                    raise PaymentError("Idempotency key already used for a different payment")
+                return True
+
+        # Conditional debit, then a credit that creates the recipient's holding if needed
+        cursor.execute('''UPDATE user_coins SET quantity = quantity - ?
+                          WHERE user_id = ? AND coin_id = ? AND quantity >= ?''',
+                       (quantity, user_ids[sender], coin_id, quantity))
+        if cursor.rowcount == 0:
+            cursor.execute("SELECT quantity FROM user_coins WHERE user_id = ? AND coin_id = ?", (user_ids[sender], coin_id))
+            balance = cursor.fetchone()
+            raise PaymentError(f"Insufficient balance. Available {balance[0] if balance else 0}")
+        cursor.execute('''INSERT INTO user_coins (user_id, coin_id, quantity) VALUES (?, ?, ?)
+                          ON CONFLICT (user_id, coin_id) DO UPDATE SET quantity = quantity + excluded.quantity''',
+                       (user_ids[receiver], coin_id, quantity))
+        cursor.execute("INSERT INTO transfers (idempotency_key, from_user_id, to_user_id, coin_id, amount) VALUES (?, ?, ?, ?, ?)",
+                       (key, user_ids[sender], user_ids[receiver], coin_id, quantity))
+        journal(cursor, [(user_ids[sender], coin_id, -quantity, "transfer_out", cursor.lastrowid),
+                         (user_ids[receiver], coin_id, quantity, "transfer_in", cursor.lastrowid)])
+        return False
+
+    async def process(self, sender: str, message: str, key: str = None):
+        """Apply an @payment message; returns (chat text, receiver, whether this was a replay)."""
+        receiver, coin_id, amount, quantity = self.parse(message)
+        if receiver == sender:
+            raise PaymentError("Cannot pay yourself")
+        if coin_id not in self.catalog.by_id:
+            await self.catalog.invalidate()
+        coin = self.catalog.by_id.get(coin_id)
+        if coin is None:
+            raise PaymentError("Coin not found")
+
+        locks = [self._lock(username) for username in sorted((sender, receiver))]
+        for lock in locks:
+            await lock.acquire()
+        try:
+            replayed = await self.db.write(self._transfer, sender, receiver, coin_id, quantity, key)
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+        symbol = coin["coinSymbol"][:-len("USDT")]
+        return f"@payment,{coin['imageUrl']},{coin['coinName']},{symbol},{amount}", receiver, replayed
+
+payments = PaymentEngine(db, catalog)
+
+def ack_deliveries(conn, username: str, seq: int, seqs=()):
+    """Drop pending deliveries up to `seq`, plus the individual `seqs`."""
+    conn.execute("DELETE FROM pending_deliveries WHERE username = ? AND seq <= ?", (username, seq))
+    conn.executemany("DELETE FROM pending_deliveries WHERE username = ? AND seq = ?", [(username, queued) for queued in seqs])
+
+def pending_page(conn, username: str, since: int, limit: int):
+    return conn.execute('''SELECT p.seq, c.from_user, c.to_user, c.message, c.timestamp
+                            FROM pending_deliveries p JOIN chats c ON c.id = p.chat_id
+                            WHERE p.username = ? AND p.seq > ?
+                            ORDER BY p.seq LIMIT ?''', (username, since, limit)).fetchall()
+
+async def replay_pending(websocket: WebSocket, username: str, since: int) -> int:
+    """Stream unacked messages after `since` in seq order; returns the last seq sent."""
+    while True:
+        rows = await db.run(pending_page, username, since, PENDING_PAGE_SIZE)
+        for seq, from_user, to_user, message, timestamp in rows:
+            await websocket.send_json({"from": from_user, "to": to_user, "message": message, "timestamp": timestamp, "seq": seq})
+        if rows:
+            since = rows[-1][0]
+        if len(rows) < PENDING_PAGE_SIZE:
+            return since
+
+async def deliver_committed(username: str, client: ClientConnection, deliveries: asyncio.Queue):
+    """Route a sender's messages to their recipients as each commits, in the order they were sent."""
+    while True:
+        item = await deliveries.get()
+        if item is None:
+            return
+        stored, payload, received = item
+        try:
+            seq = await stored
+        except sqlite3.Error as e:
+            log.error("⚠️ Database error: %s", e)
+            client.send_json({"error": "Failed to save message"})
+            continue
+
+        recipient = payload["to"]
+        try:
+            delivered = await router.deliver(recipient, encode({**payload, "seq": seq}), seq)
+            if delivered:
+                chat_fanout.observe(time.perf_counter() - received)
+            else:
+                log.debug("⚠️ %s offline", recipient)
+        except Exception as e:
+            ws_send_failures.inc("delivery")
+            log.warning("⚠️ Send error to %s: %s", recipient, e)
+
+@app.websocket("/ws/{username}")
+async def websocket_endpoint(websocket: WebSocket, username: str, since: int = None):
+    """Chat socket.
+
+    Messages to this user carry a per-user `seq`; clients confirm them with
+    {"ack": seq}, which acknowledges everything up to it that this socket has
+    sent; deliveries still on their way stay pending. Connecting with
+    ?since=<seq> acks up to `since`, streams every later unacked message in
+    order and then sends {"synced": <last seq>}. Clients that connect without
+    `since` reload history over HTTP, so their pending queue is cleared.
+    Everything after the replay goes through the connection's send queue;
+    {"ping": x} is answered with {"pong": x} and counts as activity.
+    """
+    log.info("🔗 New WebSocket connection: %s", username)
+
+    await websocket.accept()
+    if since is None:
+        await db.write(ack_deliveries, username, 2 ** 62)
+    else:
+        await db.write(ack_deliveries, username, since)
+        since = await replay_pending(websocket, username, since)
+
+    # Live deliveries queue up from here and are sent once the replay is done
+    client = ClientConnection(websocket, username, SEND_QUEUE_SIZE, SEND_OVERFLOW, CHAT_IDLE_TIMEOUT)
+    active_connections[username] = client
+    await router.connected(username)
+
+    deliveries = asyncio.Queue()
+    delivering = asyncio.create_task(deliver_committed(username, client, deliveries))
+    try:
+        if since is not None:
+            # Catch up on anything queued while the first pass ran
+            since = await replay_pending(websocket, username, since)
+            await websocket.send_json({"synced": since})
+        client.start(since or 0)
+
+        while True:
+            data = await websocket.receive_json()
+            received = time.perf_counter()
+            client.touch()
+            if "ack" in data:
+                await db.write(ack_deliveries, username, *client.acked(int(data["ack"])))
+                continue
+            if "ping" in data:
+                client.send_json({"pong": data["ping"]})
+                continue
+            recipient, message = data.get("to"), data.get("message")
+            timestamp = int(time.time())
+
+            if message.startswith("@payment"):
                 try:
-                    await websocket.send_json({
-                        "from": username,
-                        "to": recipient,
-                        "message": message,
-                        "timestamp": timestamp
-                    })
+                    message, receiver_username, replayed = await payments.process(username, message, data.get("idempotency_key"))
+                    portfolio.invalidate(username, receiver_username)
+                    payment_outcomes.inc("replayed" if replayed else "applied")
+                    if replayed:
+                        # Already applied and delivered; just confirm to the retrying sender
+                        client.send_json({"from": username, "to": recipient, "message": message, "timestamp": timestamp})
+                        continue
+                except PaymentError as e:
+                    payment_outcomes.inc("rejected")
+                    client.send_json({"error": str(e)})
+                    continue
                 except Exception as e:
-                    print(f"⚠️ Send error to {recipient}: {e}")
-
-                if recipient in active_connections:
-                    try:
-                        await active_connections[recipient].send_json({
-                            "from": username,
-                            "to": recipient,
-                            "message": message,
-                            "timestamp": timestamp
-                        })
-                    except Exception as e:
-                        print(f"⚠️ Send error to {recipient}: {e}")
-                else:
-                    print(f"⚠️ {recipient} offline")
+                    payment_outcomes.inc("failed")
+                    log.error("⚠️ Payment processing error: %s", e)
+                    client.send_json({"error": str(e)})
+                    continue
+
+            try:
+                stored = await chat_writer.save(username, recipient, message, timestamp)
+                if CHAT_DURABLE:
+                    await stored
+            except sqlite3.Error as e:
+                log.error("⚠️ Database error: %s", e)
+                client.send_json({"error": "Failed to save message"})
+                continue
+            chat_messages.inc()
+            log.debug("📩 %s → %s: %s | 🕒 %s", username, recipient, message, timestamp)
+
+            payload = {
+                "from": username,
+                "to": recipient,
+                "message": message,
+                "timestamp": timestamp
+            }
+            client.send_json(payload)
+            # Delivered once committed, without holding up the next message from this socket
+            deliveries.put_nowait((stored, payload, received))
 
     except WebSocketDisconnect:
-        print(f"❌ {username} disconnected")
+        log.info("❌ %s disconnected", username)
     except Exception as e:
-        print(f"⚠️ {username} error: {e}")
-        await websocket.send_json({"error": str(e)})
+        log.warning("⚠️ %s error: %s", username, e)
+        client.send_json({"error": str(e)})
     finally:
-        active_connections.pop(username, None)
+        await client.stop()
+        if active_connections.get(username) is client:
+            active_connections.pop(username, None)
+            await router.disconnected(username)
+        # Committed messages left undelivered stay pending for their recipients
+        deliveries.put_nowait(None)
+        await asyncio.wait({delivering}, timeout=SEND_TIMEOUT)
+        delivering.cancel()
+
 
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus text exposition of this node's counters, gauges and histograms."""
+    return Response(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/debug/profile")
+async def profile(seconds: float = 10.0, interval: float = 0.005):
+    """Sample all threads for `seconds` and return folded stacks for a flame graph.
+
+    Only served when CRYPTOSPHERE_PROFILER=1. Sampling runs on its own thread,
+    so the event loop being profiled keeps serving requests meanwhile.
+    """
+    if not PROFILER_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+    seconds = max(0.1, min(seconds, PROFILE_MAX_SECONDS))
+    counts = await asyncio.to_thread(sample_stacks, seconds, max(interval, 0.001))
+    folded = sorted(counts.items(), key=lambda item: -item[1])
+    return Response("".join(f"{stack} {count}\n" for stack, count in folded), media_type="text/plain")
 
 @app.get("/oauthredirect")
 def oauth_redirect(code: str, location: str):
-    print(f"Received OAuth redirect with code: {code} and location: {location}")
+    log.info("Received OAuth redirect with code: %s and location: %s", code, location)
     
     if not code:
-        print("Error: Authorization code missing")
+        log.warning("Error: Authorization code missing")
         raise HTTPException(status_code=400, detail="Authorization code missing")
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("server:app", host="0.0.0.0", port=4060)
-
+    # Protocol-level pings reap peers that vanished without closing
+    uvicorn.run("server:app", host="0.0.0.0", port=4060, ws_ping_interval=HEARTBEAT_INTERVAL, ws_ping_timeout=HEARTBEAT_TIMEOUT)
 
 
 
 
-# @app.get("/get_chat_history/{from_user}/{to_user}")
-# async def get_chat_history(from_user: str, to_user: str):
-#     with sqlite3.connect("chat.db") as conn:
-#         cursor = conn.cursor()
-#         cursor.execute('''
-#             SELECT from_user, to_user, message, timestamp
-#             FROM chats 
-#             WHERE (from_user = ? AND to_user = ?) OR (to_user = ? AND from_user = ?)
-#             ORDER BY timestamp
-#         ''', (from_user, to_user, from_user, to_user))
-
-#         rows = cursor.fetchall() 
-#         return [{"from": row[0], "to": row[1], "message": row[2], "timestamp": row[3]} 
-#                 for row in rows]
-
 
 # @app.get("/get_user/{username}")
 # async def get_user(username: str):
@@ -0,0 +1,53 @@
+import os
+import sqlite3
+import sys
+import tempfile
+import uuid
+
+import pytest
+
+# server.py reads its configuration and creates the schema when imported, so point it at scratch space first
+SCRATCH = tempfile.mkdtemp(prefix="cryptosphere-tests-")
+os.environ["CRYPTOSPHERE_DB"] = os.path.join(SCRATCH, "test.db")
+os.environ["CRYPTOSPHERE_PRICE_FEED"] = "none"
+os.environ["CRYPTOSPHERE_BACKPLANE"] = "local"
+os.environ["CRYPTOSPHERE_CANDLES"] = os.path.join(SCRATCH, "candles")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+
+
+def make_user(prefix="user"):
+    """Insert a user with a unique name and return (id, username)."""
+    username = f"{prefix}-{uuid.uuid4().hex[:8]}"
+    with sqlite3.connect(server.DB_PATH) as conn:
+        cursor = conn.execute("INSERT INTO users (email, username, password, profilePicture) VALUES (?, ?, ?, ?)",
+                              (f"{username}@example.com", username, "secret", ""))
+        return cursor.lastrowid, username
+
+
+def make_coin():
+    with sqlite3.connect(server.DB_PATH) as conn:
+        name = f"Testcoin {uuid.uuid4().hex[:8]}"
+        return conn.execute("INSERT INTO coins (coinName, coinSymbol, imageUrl) VALUES (?, ?, ?)",
+                            (name, "TSTUSDT", "https://example.com/tst.png")).lastrowid
+
+
+def give(user_id, coin_id, quantity):
+    with sqlite3.connect(server.DB_PATH) as conn:
+        conn.execute("INSERT INTO user_coins (user_id, coin_id, quantity) VALUES (?, ?, ?)", (user_id, coin_id, quantity))
+        conn.execute("INSERT INTO ledger (user_id, coin_id, delta, kind, timestamp) VALUES (?, ?, ?, 'opening', 0)",
+                     (user_id, coin_id, quantity))
+
+
+def balance(user_id, coin_id):
+    with sqlite3.connect(server.DB_PATH) as conn:
+        row = conn.execute("SELECT quantity FROM user_coins WHERE user_id = ? AND coin_id = ?", (user_id, coin_id)).fetchone()
+        return row[0] if row else 0.0
+
+
+@pytest.fixture
+def client():
+    from fastapi.testclient import TestClient
+    with TestClient(server.app) as client:
+        yield client
@@ -0,0 +1,102 @@
+"""A small in-process Redis-protocol server covering the commands RedisBackplane sends."""
+import asyncio
+import time
+
+import server
+
+
+def bulk(value):
+    return b"$-1\r\n" if value is None else b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+class RespStub:
+    def __init__(self):
+        self.values = {}    # key → (value, expiry on the monotonic clock)
+        self.channels = {}  # channel → [subscriber writers]
+        self.hold = None    # an asyncio.Event that, while set here and unset, stalls every reply
+        self.received = []  # command names, in arrival order
+        self._server = None
+        self._writers = []
+
+    async def start(self) -> str:
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        return f"redis://127.0.0.1:{self._server.sockets[0].getsockname()[1]}"
+
+    async def stop(self):
+        self._server.close()
+        for writer in self._writers:
+            writer.close()
+        await self._server.wait_closed()
+
+    def drop_subscribers(self, channel: str):
+        for writer in self.channels.pop(channel.encode(), []):
+            writer.close()
+
+    def expire_all(self):
+        self.values.clear()
+
+    def _get(self, key):
+        value, expires = self.values.get(key, (None, 0))
+        if value is not None and expires <= time.monotonic():
+            del self.values[key]
+            return None
+        return value
+
+    def _set(self, key, value, ttl):
+        self.values[key] = (value, time.monotonic() + int(ttl))
+        return b"+OK\r\n"
+
+    def _publish(self, channel, message):
+        subscribers = [w for w in self.channels.get(channel, []) if not w.is_closing()]
+        for subscriber in subscribers:
+            subscriber.write(b"*3\r\n" + bulk(b"message") + bulk(channel) + bulk(message))
+        return b":%d\r\n" % len(subscribers)
+
+    def _reply(self, writer, args):
+        command = args[0].upper()
+        if command == b"SUBSCRIBE":
+            self.channels.setdefault(args[1], []).append(writer)
+            return b"*3\r\n" + bulk(b"subscribe") + bulk(args[1]) + b":1\r\n"
+        if command == b"PUBLISH":
+            return self._publish(args[1], args[2])
+        if command == b"SET":
+            return self._set(args[1], args[2], args[4])
+        if command == b"GET":
+            return bulk(self._get(args[1]))
+        if command == b"EVAL":
+            script, key, node = args[1].decode(), args[3], args[4]
+            current = self._get(key)
+            if script == server.RedisBackplane.REFRESH_SCRIPT:
+                return self._set(key, node, args[5]) if current in (None, node) else b"$-1\r\n"
+            if script == server.RedisBackplane.ROUTE_SCRIPT:
+                return b":0\r\n" if current in (None, node) else self._publish(args[5] + current, args[6])
+            if script == server.RedisBackplane.CLEAR_SCRIPT:
+                if current != node:
+                    return b":0\r\n"
+                del self.values[key]
+                return b":1\r\n"
+        return b"-ERR unknown command\r\n"
+
+    async def _read(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        args = []
+        for _ in range(int(line[1:-2])):
+            length = int((await reader.readline())[1:-2])
+            args.append((await reader.readexactly(length + 2))[:-2])
+        return args
+
+    async def _handle(self, reader, writer):
+        self._writers.append(writer)
+        try:
+            while (args := await self._read(reader)) is not None:
+                self.received.append(args[0].upper().decode())
+                if self.hold is not None:
+                    await self.hold.wait()
+                writer.write(self._reply(writer, args))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
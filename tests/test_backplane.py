@@ -0,0 +1,193 @@
+import asyncio
+
+import server
+from resp_stub import RespStub
+
+
+class FakeClient:
+    def __init__(self):
+        self.frames = []
+
+    def send(self, frame, seq=None):
+        self.frames.append((frame, seq))
+        return True
+
+
+def read_reply(data: bytes):
+    async def parse():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        connection = server.RespConnection("unused", 0)
+        connection.reader = reader
+        return await connection.read()
+    return asyncio.run(parse())
+
+
+def test_resp_reply_types():
+    assert read_reply(b"+OK\r\n") == "OK"
+    assert read_reply(b":42\r\n") == 42
+    assert read_reply(b"$5\r\nhe\r\no\r\n") == b"he\r\no"
+    assert read_reply(b"$-1\r\n") is None
+    assert read_reply(b"*-1\r\n") is None
+    assert read_reply(b"*3\r\n$7\r\nmessage\r\n*1\r\n:1\r\n$0\r\n\r\n") == [b"message", [1], b""]
+    error = read_reply(b"-ERR wrong type\r\n")
+    assert isinstance(error, server.RespError) and str(error) == "ERR wrong type"
+
+
+async def routers(url, count=2):
+    pairs = []
+    for _ in range(count):
+        connections = {}
+        router = server.ChatRouter(server.make_backplane(url), connections)
+        await router.start()
+        pairs.append((router, connections))
+    await asyncio.sleep(0.05)  # let the subscriptions land
+    return pairs
+
+
+def with_stub(test):
+    async def run():
+        stub = RespStub()
+        url = await stub.start()
+        try:
+            await test(stub, url)
+        finally:
+            await stub.stop()
+    asyncio.run(run())
+
+
+def test_delivery_across_workers():
+    async def test(stub, url):
+        (a, _), (b, b_connections) = await routers(url)
+        bob = b_connections["bob"] = FakeClient()
+        await b.connected("bob")
+
+        assert await a.deliver("bob", '{"message":"hi"}', 7)
+        assert not await a.deliver("carol", '{"message":"hi"}', 1)
+        await asyncio.sleep(0.05)
+        assert bob.frames == [('{"message":"hi"}', 7)]
+        await a.stop()
+        await b.stop()
+    with_stub(test)
+
+
+def test_clear_keeps_an_entry_another_node_took_over():
+    async def test(stub, url):
+        (a, a_connections), (b, b_connections) = await routers(url)
+        b_connections["bob"] = FakeClient()
+        await b.connected("bob")
+        a_connections["bob"] = FakeClient()
+        await a.connected("bob")
+
+        await b.disconnected("bob")
+        await b.backplane.refresh_presence(["bob"], b.node)
+        assert await a.backplane.locate("bob") == a.node
+        await a.stop()
+        await b.stop()
+    with_stub(test)
+
+
+def test_dead_node_is_not_a_delivery_and_its_presence_expires():
+    async def test(stub, url):
+        (a, _), (b, b_connections) = await routers(url)
+        b_connections["dave"] = FakeClient()
+        await b.connected("dave")
+        stub.drop_subscribers(b.channel)  # b's worker dies without clearing presence
+        await asyncio.sleep(0.05)
+
+        assert not await a.deliver("dave", "{}", 1)
+        stub.expire_all()  # its presence TTL runs out
+        assert await a.backplane.locate("dave") is None
+        await a.stop()
+        await b.stop()
+    with_stub(test)
+
+
+def test_cancelled_command_does_not_leave_its_reply_behind():
+    async def test(stub, url):
+        backplane = server.make_backplane(url)
+        await backplane.set_presence("alice", "node-a")
+        await backplane.set_presence("bob", "node-b")
+
+        stub.hold = asyncio.Event()
+        lookup = asyncio.create_task(backplane.locate("alice"))
+        await asyncio.sleep(0.05)
+        lookup.cancel()
+        await asyncio.gather(lookup, return_exceptions=True)
+        stub.hold.set()
+        stub.hold = None
+
+        assert await backplane.locate("bob") == "node-b"
+        assert await backplane.locate("alice") == "node-a"
+        backplane._commands.close()
+    with_stub(test)
+
+
+def test_error_reply_raises_and_keeps_the_connection_in_sync():
+    async def test(stub, url):
+        backplane = server.make_backplane(url)
+        await backplane.set_presence("alice", "node-a")
+        try:
+            await backplane._commands.command("NOPE")
+        except server.RespError as e:
+            assert "unknown command" in str(e)
+        else:
+            raise AssertionError("error reply was not raised")
+        assert await backplane.locate("alice") == "node-a"
+        backplane._commands.close()
+    with_stub(test)
+
+
+def test_delivery_to_another_worker_is_one_round_trip():
+    async def test(stub, url):
+        (a, _), (b, b_connections) = await routers(url)
+        b_connections["bob"] = FakeClient()
+        await b.connected("bob")
+        stub.received.clear()
+
+        assert await a.deliver("bob", "{}", 1)
+        assert await b.deliver("bob", "{}", 2)  # local, so no command at all
+        assert stub.received == ["EVAL"]
+        await a.stop()
+        await b.stop()
+    with_stub(test)
+
+
+def test_commands_are_pipelined():
+    async def test(stub, url):
+        backplane = server.make_backplane(url)
+        for i in range(5):
+            await backplane.set_presence(f"user{i}", f"node-{i}")
+        stub.received.clear()
+
+        stub.hold = asyncio.Event()
+        lookups = [asyncio.create_task(backplane.locate(f"user{i}")) for i in range(5)]
+        await asyncio.sleep(0.05)
+        in_flight = len(backplane._commands._pending)
+        stub.hold.set()
+        stub.hold = None
+
+        assert in_flight == 5  # all sent before the first reply came back
+        assert await asyncio.gather(*lookups) == [f"node-{i}" for i in range(5)]
+        backplane._commands.close()
+    with_stub(test)
+
+
+def test_lost_connection_fails_waiting_commands_and_reconnects():
+    async def test(stub, url):
+        backplane = server.make_backplane(url)
+        await backplane.set_presence("alice", "node-a")
+        stub.hold = asyncio.Event()
+        lookup = asyncio.create_task(backplane.locate("alice"))
+        await asyncio.sleep(0.05)
+        for writer in stub._writers:
+            writer.close()
+        stub.hold.set()
+        stub.hold = None
+
+        results = await asyncio.gather(lookup, return_exceptions=True)
+        assert isinstance(results[0], ConnectionError)
+        assert await backplane.locate("alice") == "node-a"
+        backplane._commands.close()
+    with_stub(test)
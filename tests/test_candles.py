@@ -0,0 +1,38 @@
+import asyncio
+import tempfile
+
+import server
+
+
+def test_ticks_right_after_start_are_recorded():
+    async def run():
+        store = server.CandleStore(tempfile.mkdtemp(prefix="candles-"), {"1m": 60_000}, 3600)
+        await store.start()
+        # What a feed started straight after the store delivers first
+        store.record([("BTC", 100.0, 60_000), ("BTC", 103.0, 61_000)])
+        store.record([("BTC", 98.0, 62_000), ("BTC", 102.0, 63_000)])
+        store.record([("BTC", 101.0, 120_000)])
+        history = await store.history("BTC", 60_000, 0, 180_000, 10)
+        await store.stop()
+        return history
+
+    assert asyncio.run(run()) == (60_000, [
+        {"time": 60_000, "open": 100.0, "high": 103.0, "low": 98.0, "close": 102.0, "volume": 4},
+        {"time": 120_000, "open": 101.0, "high": 101.0, "low": 101.0, "close": 101.0, "volume": 1},
+    ])
+
+
+def test_a_second_store_on_the_same_directory_only_reads():
+    directory = tempfile.mkdtemp(prefix="candles-")
+
+    async def run():
+        first = server.CandleStore(directory, {"1m": 60_000}, 3600)
+        second = server.CandleStore(directory, {"1m": 60_000}, 3600)
+        await first.start()
+        await second.start()
+        writing = first.writing, second.writing
+        await second.stop()
+        await first.stop()
+        return writing
+
+    assert asyncio.run(run()) == (True, server.fcntl is None)
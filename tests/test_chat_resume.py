@@ -0,0 +1,105 @@
+import asyncio
+import sqlite3
+import time
+
+import server
+from conftest import make_user
+
+
+def pending(username):
+    with sqlite3.connect(server.DB_PATH) as conn:
+        return [seq for seq, in conn.execute("SELECT seq FROM pending_deliveries WHERE username = ? ORDER BY seq", (username,))]
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_resume_replays_unacked_messages_in_order(client):
+    _, alice = make_user("alice")
+    _, bob = make_user("bob")
+
+    with client.websocket_connect(f"/ws/{alice}") as a:
+        for i in range(5):
+            a.send_json({"to": bob, "message": f"m{i}"})
+            assert a.receive_json()["message"] == f"m{i}"
+        wait_for(lambda: len(pending(bob)) == 5)
+        seqs = pending(bob)
+
+        with client.websocket_connect(f"/ws/{bob}?since={seqs[1]}") as b:
+            replayed = [b.receive_json() for _ in range(3)]
+            assert [(m["seq"], m["message"]) for m in replayed] == list(zip(seqs[2:], ["m2", "m3", "m4"]))
+            assert b.receive_json() == {"synced": seqs[-1]}
+            assert pending(bob) == seqs[2:]  # connecting acked up to `since`
+
+            a.send_json({"to": bob, "message": "live"})
+            a.receive_json()
+            live = b.receive_json()
+            assert (live["seq"], live["message"]) == (seqs[-1] + 1, "live")
+            b.send_json({"ack": live["seq"]})
+            b.send_json({"ping": 1})
+            assert b.receive_json() == {"pong": 1}  # nothing was delivered twice
+            assert pending(bob) == []
+
+        with client.websocket_connect(f"/ws/{bob}?since={seqs[-1] + 1}") as b:
+            assert b.receive_json() == {"synced": seqs[-1] + 1}
+
+
+def test_deliveries_already_replayed_are_not_sent_again():
+    class Socket:
+        def __init__(self):
+            self.sent = []
+
+        async def send_text(self, text):
+            self.sent.append(text)
+
+    async def run():
+        socket = Socket()
+        connection = server.ClientConnection(socket, "bob", 10, "drop_oldest", 0)
+        # Committed while the replay was running: 3 and 4 were replayed, 5 was not
+        for seq in (3, 4, 5):
+            connection.send(f"delivery {seq}", seq)
+        connection.send("echo")
+        connection.start(4)
+        connection.send("delivery 4", 4)
+        connection.send("delivery 6", 6)
+        await connection.stop()
+        return socket.sent
+
+    assert asyncio.run(run()) == ["delivery 5", "echo", "delivery 6"]
+
+
+def test_ack_keeps_deliveries_that_have_not_arrived():
+    _, bob = make_user("bob")
+
+    async def run():
+        stored = [await server.chat_writer.save("alice", bob, f"m{i}", 0) for i in range(4)]
+        seqs = await asyncio.gather(*stored)
+        connection = server.ClientConnection(None, bob, 10, "drop_oldest", 0)
+        connection.start(seqs[0])  # the resume replay covered the first one
+        connection._writer.cancel()
+        # The last delivery overtakes the two before it, and the client acks it
+        connection.send("late", seqs[3])
+        await server.db.write(server.ack_deliveries, bob, *connection.acked(seqs[3]))
+        trimmed_early = pending(bob)
+        connection.send("on time", seqs[1])
+        await server.db.write(server.ack_deliveries, bob, *connection.acked(seqs[3]))
+        trimmed_later = pending(bob)
+        # Acking a seq that was never sent trims nothing
+        await server.db.write(server.ack_deliveries, bob, *connection.acked(seqs[3] + 10))
+        return seqs, trimmed_early, trimmed_later, pending(bob)
+
+    async def with_writer():
+        server.chat_writer.start()
+        try:
+            return await run()
+        finally:
+            await server.chat_writer.stop()
+
+    seqs, trimmed_early, trimmed_later, trimmed_last = asyncio.run(with_writer())
+    assert trimmed_early == seqs[1:3]
+    assert trimmed_later == seqs[2:3]
+    assert trimmed_last == seqs[2:3]
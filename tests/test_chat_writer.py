@@ -0,0 +1,55 @@
+import asyncio
+
+import server
+from conftest import make_user
+
+
+class CountingWriter(server.ChatWriter):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.batches = []
+
+    async def _flush(self, batch):
+        self.batches.append(len(batch))
+        await super()._flush(batch)
+
+
+def save_spread_out(writer, count, gap):
+    async def run():
+        writer.start()
+        _, bob = make_user("bob")
+        stored = []
+        for i in range(count):
+            stored.append(await writer.save("alice", bob, f"m{i}", 0))
+            await asyncio.sleep(gap)
+        seqs = await asyncio.gather(*stored)
+        await writer.stop()
+        return seqs
+    return asyncio.run(run())
+
+
+def test_messages_within_the_deadline_share_a_commit():
+    writer = CountingWriter(server.db, 256, 0.2, 100)
+    assert save_spread_out(writer, 3, 0.01) == [1, 2, 3]
+    assert writer.batches == [3]
+
+
+def test_batches_close_at_max_size():
+    writer = CountingWriter(server.db, 2, 0.2, 100)
+    assert save_spread_out(writer, 5, 0) == [1, 2, 3, 4, 5]
+    assert writer.batches == [2, 2, 1]
+
+
+def test_without_a_deadline_a_lone_message_commits_straight_away():
+    writer = CountingWriter(server.db, 256, 0, 100)
+    save_spread_out(writer, 3, 0.05)
+    assert writer.batches == [1, 1, 1]
+
+
+def test_durable_writes_are_fsynced_and_restore_the_default():
+    synchronous = lambda conn: conn.execute("PRAGMA synchronous").fetchone()[0]
+
+    async def run():
+        return (await server.db.write(synchronous, durable=True), await server.db.write(synchronous))
+
+    assert asyncio.run(run()) == (2, 1)  # FULL, then back to NORMAL
@@ -0,0 +1,29 @@
+import asyncio
+import sqlite3
+import time
+
+import server
+
+
+def test_reads_proceed_while_writes_wait_on_another_process():
+    holder = sqlite3.connect(server.DB_PATH, isolation_level=None)
+    holder.execute("BEGIN IMMEDIATE")  # e.g. ledger.py rebuild holding the write lock
+
+    async def run():
+        writes = [asyncio.ensure_future(server.db.write(server.ack_deliveries, "nobody", i)) for i in range(2 * server.DB_WORKERS)]
+        await asyncio.sleep(0.05)
+        started = time.perf_counter()
+        count = await asyncio.wait_for(server.db.run(lambda conn: conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]), 5)
+        waited = time.perf_counter() - started
+        holder.execute("COMMIT")
+        await asyncio.gather(*writes)
+        return count, waited
+
+    try:
+        count, waited = asyncio.run(run())
+    finally:
+        if holder.in_transaction:
+            holder.execute("COMMIT")
+        holder.close()
+    assert count >= 0
+    assert waited < 1.0
@@ -0,0 +1,20 @@
+import json
+
+from conftest import make_user
+
+
+def test_export_never_includes_passwords(client):
+    make_user("exported")
+    response = client.get("/export/users", headers={"Accept-Encoding": "identity"})
+    records = [json.loads(line) for line in response.text.splitlines()]
+    assert records and all("password" not in record for record in records)
+
+    for fields in ("password", "username,password"):
+        response = client.get("/export/users", params={"fields": fields})
+        assert response.status_code == 400
+        assert "password" in response.json()["detail"]
+
+
+def test_get_users_rejects_an_explicit_password_projection(client):
+    assert client.get("/get_users", params={"fields": "password"}).status_code == 400
+    assert client.get("/get_users", params={"fields": "username", "limit": 5}).status_code == 200
@@ -0,0 +1,87 @@
+import asyncio
+import sqlite3
+
+import pytest
+from fastapi import HTTPException
+
+import server
+from conftest import balance, give, make_coin, make_user
+
+
+def payment(coin_id, amount, receiver):
+    return f"@payment,{coin_id},{amount},{receiver}_{coin_id}"
+
+
+def journaled(user_id, coin_id):
+    with sqlite3.connect(server.DB_PATH) as conn:
+        return conn.execute("SELECT COALESCE(SUM(delta), 0) FROM ledger WHERE user_id = ? AND coin_id = ?", (user_id, coin_id)).fetchone()[0]
+
+
+def test_concurrent_sells_and_payments_never_overdraw():
+    coin_id = make_coin()
+    seller_id, seller = make_user("seller")
+    receiver_id, receiver = make_user("receiver")
+    give(seller_id, coin_id, 10.0)
+
+    async def race():
+        await server.catalog.invalidate()  # so payments don't wait on a catalog refresh while the sells run
+        trades = []
+        for _ in range(12):
+            trades.append(server.db.write(server.apply_sell, seller, coin_id, 1.0))
+            trades.append(server.payments.process(seller, payment(coin_id, 1, receiver)))
+        return await asyncio.gather(*trades, return_exceptions=True)
+
+    results = asyncio.run(race())
+    sold = sum(1 for r in results[0::2] if not isinstance(r, Exception))
+    paid = sum(1 for r in results[1::2] if not isinstance(r, Exception))
+    for failure in results:
+        if isinstance(failure, Exception):
+            assert isinstance(failure, (HTTPException, server.PaymentError))
+
+    assert sold + paid == 10, (sold, paid)
+    assert sold and paid
+    assert balance(seller_id, coin_id) == 0.0
+    assert balance(receiver_id, coin_id) == paid
+    assert journaled(seller_id, coin_id) == 0.0
+    assert journaled(receiver_id, coin_id) == paid
+
+
+def test_payment_replay_applies_once():
+    coin_id = make_coin()
+    sender_id, sender = make_user("sender")
+    receiver_id, receiver = make_user("receiver")
+    give(sender_id, coin_id, 5.0)
+
+    first = asyncio.run(server.payments.process(sender, payment(coin_id, 2, receiver), "retry-me-" + sender))
+    again = asyncio.run(server.payments.process(sender, payment(coin_id, 2, receiver), "retry-me-" + sender))
+
+    assert first[1:] == (receiver, False)
+    assert again == (first[0], receiver, True)
+    assert balance(sender_id, coin_id) == 3.0
+    assert balance(receiver_id, coin_id) == 2.0
+    with sqlite3.connect(server.DB_PATH) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM transfers WHERE idempotency_key = ?", ("retry-me-" + sender,)).fetchone()[0] == 1
+
+
+def test_reused_key_for_a_different_payment_is_rejected():
+    coin_id = make_coin()
+    sender_id, sender = make_user("sender")
+    _, receiver = make_user("receiver")
+    give(sender_id, coin_id, 5.0)
+
+    asyncio.run(server.payments.process(sender, payment(coin_id, 2, receiver), "key-" + sender))
+    with pytest.raises(server.PaymentError, match="different payment"):
+        asyncio.run(server.payments.process(sender, payment(coin_id, 3, receiver), "key-" + sender))
+    assert balance(sender_id, coin_id) == 3.0
+
+
+def test_payment_beyond_balance_is_rejected():
+    coin_id = make_coin()
+    sender_id, sender = make_user("sender")
+    receiver_id, receiver = make_user("receiver")
+    give(sender_id, coin_id, 1.0)
+
+    with pytest.raises(server.PaymentError, match="Insufficient balance. Available 1.0"):
+        asyncio.run(server.payments.process(sender, payment(coin_id, 2, receiver)))
+    assert balance(sender_id, coin_id) == 1.0
+    assert balance(receiver_id, coin_id) == 0.0
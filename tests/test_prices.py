@@ -0,0 +1,44 @@
+import asyncio
+
+import server
+
+
+def test_malformed_subscriptions_get_an_error_frame(client):
+    server.price_hub.publish([("BTCUSDT", 100.0, 1), ("ETHUSDT", 10.0, 1)])
+    with client.websocket_connect("/ws/prices") as ws:
+        ws.send_json({"subscribe": "BTCUSDT"})
+        assert ws.receive_json() == {"error": "subscribe takes a list of symbols"}
+        ws.send_text("not json")
+        assert ws.receive_json() == {"error": "Invalid JSON"}
+        ws.send_json(["BTCUSDT"])
+        assert ws.receive_json() == {"error": "Expected an object"}
+
+        ws.send_json({"subscribe": ["btcusdt"]})
+        assert ws.receive_json() == {"prices": [{"symbol": "BTCUSDT", "price": 100.0, "timestamp": 1}]}
+    assert "B" not in server.price_hub._by_symbol
+    assert server.price_hub.subscriber_count() == 0
+
+
+def test_stalled_price_stream_is_closed():
+    class Socket:
+        def __init__(self):
+            self.closed = None
+
+        async def send_json(self, frame):
+            await asyncio.sleep(3600)
+
+        async def close(self, code):
+            self.closed = code
+
+    async def run():
+        socket = Socket()
+        subscriber = server.PriceSubscriber()
+        subscriber.push({"symbol": "BTCUSDT", "price": 1.0, "timestamp": 1})
+        await asyncio.wait_for(subscriber.drain(socket), 5)
+        return socket.closed
+
+    timeout, server.SEND_TIMEOUT = server.SEND_TIMEOUT, 0.05
+    try:
+        assert asyncio.run(run()) == 1013
+    finally:
+        server.SEND_TIMEOUT = timeout